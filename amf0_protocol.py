@@ -18,6 +18,9 @@ unsupported_marker = 0x0D
 xml_document_marker = 0x0F
 typed_object_marker = 0x10
 
+# objects and arrays nested deeper than this are refused, decoding is recursive
+MAX_DEPTH = 32
+
 
 class AMF0:
     def __init__(self, *args, **kwargs):
@@ -35,39 +38,49 @@ class AMF0:
         return self.obj
 
     def compile(self):
-        res = bytes()
-        for data in self.obj:
-            res += self.compile_amf0(data)
-        return res
+        return b''.join([self.compile_amf0(data) for data in self.obj])
 
     def compile_amf0(self, data):
         # TODO implement amf0 fully
-        res = bytes()
         if isinstance(data, str):
+            data = data.encode()
+        if isinstance(data, (bytes, bytearray, memoryview)):
             if len(data) > 0xffff:
-                res += bytes.fromhex(f'{long_string_marker}') + struct.pack('>Q', len(data)) + data.encode()
-            else:
-                res += bytes.fromhex(f'{string_marker}') + struct.pack('>I', len(data)) + data.encode()
-        elif isinstance(data, float):
-            res += bytes.fromhex(f'{number_marker}') + struct.pack('>d', data)
-        elif isinstance(data, dict):
-            res += self.compile_obj(data)
+                return struct.pack('>BI', long_string_marker, len(data)) + data
+            return struct.pack('>BH', string_marker, len(data)) + data
         elif isinstance(data, bool):
-            res += bytes.fromhex(f'{boolean_marker}') + struct.pack('>?', data)
+            return struct.pack('>B?', boolean_marker, data)
+        elif isinstance(data, (int, float)):
+            return struct.pack('>Bd', number_marker, data)
+        elif isinstance(data, dict):
+            return self.compile_obj(data)
+        elif isinstance(data, (list, tuple)):
+            return struct.pack('>BI', strict_array_marker, len(data)) + \
+                b''.join([self.compile_amf0(_) for _ in data])
+        elif data is None:
+            return struct.pack('>B', null_marker)
         else:
             raise NotImplementedError(f"type {type(data)} is not implemented...")
-        return res
 
     def compile_obj(self, obj: dict):
         # TODO support amf0 fully
-        res = bytes.fromhex(f'{object_marker}')
-        for key in obj.keys():
-            res += struct.pack('>I', len(key)) + key.compile()
-            res += self.compile_amf0(obj[key])
-        res += object_end_marker
-        return res
-
-    def parse_types(self, msg: bytes):
+        res = [struct.pack('>B', object_marker)]
+        for key, value in obj.items():
+            if isinstance(key, str):
+                key = key.encode()
+            res.append(struct.pack('>H', len(key)) + key)
+            res.append(self.compile_amf0(value))
+        res.append(object_end_marker)
+        return b''.join(res)
+
+    def parse_types(self, msg: bytes, depth: int = 0):
+        """
+        decode the value at the start of `msg`, returns (value, bytes left).
+        raises ValueError on unsupported types, truncated strings, invalid dates and values nested deeper
+        than `MAX_DEPTH`, IndexError or struct.error on other truncated input
+        """
+        if depth > MAX_DEPTH:
+            raise ValueError(f"amf0 values nested deeper than ({MAX_DEPTH})")
         type = msg[0]
         if type == number_marker:
             return struct.unpack('>d', msg[1:9])[0], msg[9:]
@@ -75,39 +88,90 @@ class AMF0:
             return (False if msg[1] == 0 else True), msg[2:]
         elif type == string_marker:
             mlen = int.from_bytes(msg[1:3], 'big')
-            return msg[3: 3 + mlen], msg[3 + mlen:]
+            if len(msg) < 3 + mlen:
+                raise ValueError("truncated amf0 string")
+            return bytes(msg[3: 3 + mlen]), msg[3 + mlen:]
         elif type == object_marker:
-            # first, calculate where the object end is...
-            idx = 1
-            while msg[idx:idx+3] != object_end_marker:
-                idx += 1
-            obj = msg[1:idx]
-            msg = msg[idx+3:]
-
             # object notation is *(`keylen`:u16, `key`:string, `value_type`:marker, `value`: Any.. )
-            obj_res = {}
-            while len(obj) > 0:
-                keylen = int.from_bytes(obj[0:2], 'big')
-                key = obj[2:2+keylen]
-                value, obj = self.parse_types(obj[2+keylen:])
-                obj_res[key] = value
-
-            return obj, msg
-
+            return self.parse_properties(msg[1:], depth)
+        elif type == ecma_array_marker:
+            # ecma array is `count`:u32 followed by object notation
+            return self.parse_properties(msg[5:], depth)
         elif type in (null_marker, undefined_marker):
             return None, msg[1:]
         elif type == reference_marker:
             pass  # TODO implement amf0 fully
         elif type == strict_array_marker:
-            pass  # TODO implement amf0 fully
+            count = int.from_bytes(msg[1:5], 'big')
+            msg = msg[5:]
+            arr = []
+            for _ in range(count):
+                value, msg = self.parse_types(msg, depth + 1)
+                arr.append(value)
+            return arr, msg
         elif type == date_marker:
-            return datetime.fromtimestamp(float.fromhex(msg[1:9].hex())), msg[10:]
+            # milliseconds since epoch (double), then a 2 bytes time zone which is reserved
+            if len(msg) < 11:
+                raise ValueError("truncated amf0 date")
+            try:
+                return datetime.fromtimestamp(struct.unpack('>d', msg[1:9])[0] / 1000), msg[11:]
+            except (OverflowError, OSError, ValueError):
+                raise ValueError("amf0 date out of range")
         elif type == long_string_marker:
             mlen = int.from_bytes(msg[1:5], 'big')
-            return msg[5:5 + mlen], msg[5 + mlen:]
+            if len(msg) < 5 + mlen:
+                raise ValueError("truncated amf0 string")
+            return bytes(msg[5:5 + mlen]), msg[5 + mlen:]
         elif type == xml_document_marker:
             mlen = int.from_bytes(msg[1:5], 'big')
             xml = msg[5:5 + mlen]
             pass  # TODO implement amf0 fully
         elif type == typed_object_marker:
             pass  # TODO implement amf0 fully
+        raise ValueError(f"unsupported amf0 type ({type})")
+
+    def parse_properties(self, msg: bytes, depth: int = 0):
+        obj_res = {}
+        while msg[:3] != object_end_marker:
+            keylen = int.from_bytes(msg[0:2], 'big')
+            key = bytes(msg[2:2+keylen])
+            value, msg = self.parse_types(msg[2+keylen:], depth + 1)
+            obj_res[key] = value
+
+        return obj_res, msg[3:]
+
+
+class LazyAMF0:
+    """
+    amf0 message decoded only up to the command name and transaction id.
+    - `raw` keeps the whole message as a memoryview, forward it without re-encoding
+    - `body` is the rest of the message after the command name (and transaction id)
+    - `obj` decodes the whole message on first access, same as `AMF0(raw).obj`
+    """
+    __slots__ = ('raw', 'command', 'transaction_id', 'body_index', '_obj')
+
+    def __init__(self, msg: bytes):
+        self.raw = memoryview(msg)
+        self.command = None
+        self.transaction_id = None
+        self._obj = None
+
+        amf = AMF0()
+        rest = self.raw
+        if len(rest) > 0 and rest[0] in (string_marker, long_string_marker):
+            command, rest = amf.parse_types(rest)
+            self.command = bytes(command).decode()
+            # data messages (@setDataFrame, onMetaData..) have no transaction id
+            if len(rest) > 0 and rest[0] == number_marker:
+                self.transaction_id, rest = amf.parse_types(rest)
+        self.body_index = len(self.raw) - len(rest)
+
+    @property
+    def body(self):
+        return self.raw[self.body_index:]
+
+    @property
+    def obj(self):
+        if self._obj is None:
+            self._obj = AMF0(self.raw).obj
+        return self._obj
@@ -0,0 +1,112 @@
+"""
+memory/throughput benchmark of the slotted message objects against the dict based ones.
+both variants parses the same header and the same control message payload.
+
+usage: python benchmarks/bench_objects.py [count]
+"""
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from rtmp_protocol import RTMPHeader, RTMPPayload  # noqa: E402
+from rtmp_stream import StreamObject  # noqa: E402
+
+# fmt 0, csid 2, timestamp 1000, length 4, type 1 (set chunk size), stream id 0 + payload
+PACKET = bytes.fromhex('02' '0003e8' '000004' '01' '00000000') + b'\x00\x00\x10\x00'
+
+
+class DictHeader:
+    """RTMPHeader as it was before `__slots__`: attributes live in a per-instance dict"""
+    TIMESTAMP_MAX = RTMPHeader.TIMESTAMP_MAX
+    COMPILE_KEYS = RTMPHeader.COMPILE_KEYS
+    MESSAGE_HEADER_SIZE = RTMPHeader.MESSAGE_HEADER_SIZE
+    chunk_stream_id = None
+    timestamp_delta = None
+    message_length = None
+    chunk_type = None
+    message_stream_id = None
+    fmt = None
+    header_index = 0
+
+    parse = RTMPHeader.parse
+
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+        if len(args) == 1:
+            self.parse(args[0])
+
+
+class DictPayload:
+    """RTMPPayload as it was before `__slots__`"""
+    data = None
+    message = None
+
+    parse = RTMPPayload.parse
+    parse_amf0 = RTMPPayload.parse_amf0
+    parse_protocol_control_message = RTMPPayload.parse_protocol_control_message
+
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+        if len(args) == 3:
+            self.parse(args[0], args[1], args[2])
+
+
+def parse_dict(stream: StreamObject):
+    header = DictHeader(PACKET)
+    return header, DictPayload(header, PACKET[header.header_index:], stream)
+
+
+def parse_slots(stream: StreamObject):
+    header = RTMPHeader(PACKET)
+    return header, RTMPPayload(header, PACKET[header.header_index:], stream)
+
+
+VARIANTS = (
+    ('dict', parse_dict),
+    ('slots', parse_slots),
+)
+
+
+def measure_memory(parse, count: int):
+    """bytes per live message (header + payload), and bytes still allocated once every message was dropped"""
+    stream = StreamObject(max_size=128)
+    gc.collect()
+    tracemalloc.start()
+    messages = [parse(stream) for _ in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    del messages
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / count, retained
+
+
+def measure_parse(parse, count: int):
+    stream = StreamObject(max_size=128)
+    collections = sum(_['collections'] for _ in gc.get_stats())
+
+    start = time.perf_counter()
+    for _ in range(count):
+        parse(stream)
+    elapsed = time.perf_counter() - start
+
+    collections = sum(_['collections'] for _ in gc.get_stats()) - collections
+    return count / elapsed, collections
+
+
+def main(count: int):
+    print(f"{'variant':<8} {'bytes/message':>14} {'retained':>10} {'parse/s':>12} {'gc runs':>8}")
+    for name, parse in VARIANTS:
+        size, retained = measure_memory(parse, count)
+        rate, collections = measure_parse(parse, count)
+        print(f"{name:<8} {size:>14.1f} {retained:>10} {rate:>12.0f} {collections:>8}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
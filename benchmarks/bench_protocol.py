@@ -0,0 +1,108 @@
+"""
+microbenchmarks of the protocol layer: chunk header, message parser, outbound chunking and amf0 codec.
+
+usage: python benchmarks/bench_protocol.py [-k filter] [-o result.json] [-c baseline.json]
+"""
+import random
+import struct
+import sys
+
+from runner import Case, main
+
+from amf0_protocol import AMF0
+from rtmp_constants import *
+from rtmp_protocol import RTMP, RTMPHeader
+from rtmp_stream import StreamObject
+
+SEED = 0x524d5450
+CHUNK_SIZE = 4096
+
+
+def make_bytes(size: int, rng: random.Random):
+    return rng.getrandbits(size * 8).to_bytes(size, 'big') if size else b''
+
+
+def header_cases():
+    cases = []
+    for fmt in (0, 1, 2, 3):
+        for width, cs_id in ((1, 3), (2, 100), (3, 1000)):
+            header = RTMPHeader(fmt=fmt, chunk_stream_id=cs_id, timestamp_delta=40, message_length=1000,
+                                chunk_type=TYPE_VIDEO, message_stream_id=1)
+            packet = header.compile() + b'\x00' * 16
+
+            cases.append(Case(f'header.parse[fmt={fmt},csid={width}B]', lambda p=packet: RTMPHeader(p)))
+            cases.append(Case(f'header.compile[fmt={fmt},csid={width}B]', header.compile))
+    return cases
+
+
+def make_message(mtype: int, cs_id: int, timestamp: int, payload: bytes):
+    return RTMP(mtype=mtype, cid=cs_id, mid=1, timedelta=timestamp, fmt=0,
+                chunk={'data': payload}).compile(chunk_size=CHUNK_SIZE)
+
+
+def parse_cases(rng: random.Random):
+    # interleaved audio (aac frame ~200B) and video (~1KB) messages, as a publisher sends them
+    audio = make_bytes(200, rng)
+    video = make_bytes(1000, rng)
+
+    cases = []
+    for count in (1, 10, 100, 1000):
+        buffer = b''.join(make_message(TYPE_AUDIO, 4, i * 23, audio) if i % 2 else
+                          make_message(TYPE_VIDEO, 6, i * 33, video) for i in range(count))
+        stream = StreamObject(max_size=1024 * 1024, chunk_size=CHUNK_SIZE, start_time=0)
+
+        def parse(buffer=buffer, stream=stream):
+            RTMP().parse(buffer, stream)
+        cases.append(Case(f'rtmp.parse[messages={count}]', parse, count))
+    return cases
+
+
+def chunk_cases(rng: random.Random):
+    cases = []
+    for size in (4 * 1024, 64 * 1024, 1024 * 1024):
+        message = RTMP(mtype=TYPE_VIDEO, cid=6, mid=1, timedelta=0, fmt=0,
+                       chunk={'data': make_bytes(size, rng)})
+        cases.append(Case(f'rtmp.compile[payload={size // 1024}KB,chunk={CHUNK_SIZE}]',
+                          lambda m=message: m.compile(chunk_size=CHUNK_SIZE), size))
+    return cases
+
+
+def ecma_array(obj: dict):
+    # `AMF0.compile` writes dicts as objects, encoders send onMetaData as ecma array
+    return b'\x08' + struct.pack('>I', len(obj)) + AMF0(obj=[obj]).compile()[1:]
+
+
+def amf0_cases():
+    connect = ['connect', 1.0, {
+        'app': 'live', 'type': 'nonprivate', 'flashVer': 'FMLE/3.0 (compatible; FMSc/1.0)',
+        'swfUrl': 'rtmp://127.0.0.1:1935/live', 'tcUrl': 'rtmp://127.0.0.1:1935/live',
+    }]
+    metadata = {
+        'duration': 0.0, 'fileSize': 0.0, 'width': 1920.0, 'height': 1080.0, 'videocodecid': 7.0,
+        'videodatarate': 6000.0, 'framerate': 60.0, 'audiocodecid': 10.0, 'audiodatarate': 160.0,
+        'audiosamplerate': 48000.0, 'audiosamplesize': 16.0, 'audiochannels': 2.0, 'stereo': True,
+        '2.1': False, '3.1': False, '4.0': False, '4.1': False, '5.1': False, '7.1': False,
+        'encoder': 'obs-output module (libobs version 29.1.3)',
+    }
+    on_status = ['onStatus', 0.0, None, {
+        'level': 'status', 'code': 'NetStream.Publish.Start', 'description': 'Start publishing',
+    }]
+
+    cases = []
+    for name, obj, encoded in (
+            ('connect', connect, AMF0(obj=connect).compile()),
+            ('onMetaData', ['@setDataFrame', 'onMetaData', metadata],
+             AMF0(obj=['@setDataFrame', 'onMetaData']).compile() + ecma_array(metadata)),
+            ('onStatus', on_status, AMF0(obj=on_status).compile())):
+        cases.append(Case(f'amf0.decode[{name}]', lambda b=encoded: AMF0(b)))
+        cases.append(Case(f'amf0.encode[{name}]', lambda o=obj: AMF0(obj=o).compile()))
+    return cases
+
+
+def all_cases():
+    rng = random.Random(SEED)
+    return header_cases() + parse_cases(rng) + chunk_cases(rng) + amf0_cases()
+
+
+if __name__ == '__main__':
+    sys.exit(main('protocol', all_cases()))
@@ -0,0 +1,127 @@
+"""
+stdlib only benchmark runner.
+- every case is timed with `timeit`, gc disabled, `repeat` times; the median is the reported value
+- results are written as json along with the git revision and interpreter,
+    pass a previous result with `--compare` to catch regressions between commits
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, REPO_PATH)
+
+DEFAULT_REPEAT = 7
+DEFAULT_MIN_TIME = 0.2  # seconds per repeat
+DEFAULT_THRESHOLD = 0.10  # 10% slower is a regression
+
+
+class Case:
+    __slots__ = ('name', 'func', 'items')
+
+    def __init__(self, name: str, func, items: int = 1):
+        """
+        :param name: unique, stable name. results are compared by name across commits
+        :param func: callable without argument, one call is one operation
+        :param items: number of items (messages, bytes..) handled per operation, for throughput
+        """
+        self.name = name
+        self.func = func
+        self.items = items
+
+
+def git_revision():
+    try:
+        res = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH,
+                             capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return res.stdout.strip()
+
+
+def run_case(case: Case, repeat: int, min_time: float):
+    timer = timeit.Timer(case.func)
+
+    # calibrate: smallest number of calls taking at least `min_time`
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / elapsed) + 1) if elapsed > 0 else number * 10
+
+    times = [_ / number * 1e9 for _ in timer.repeat(repeat=repeat, number=number)]
+    median = statistics.median(times)
+    return {
+        'ns_per_op': median,
+        'min_ns_per_op': min(times),
+        'stdev_ns': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'number': number,
+        'repeat': repeat,
+        'items_per_op': case.items,
+        'items_per_sec': case.items / median * 1e9,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """print ratio against `baseline` results, returns names of regressed cases"""
+    regressions = []
+    print(f"\n{'case':<48} {'baseline':>12} {'current':>12} {'ratio':>7}", file=sys.stderr)
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['ns_per_op']
+        ratio = res['ns_per_op'] / old
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print(f"{name:<48} {old:>12.0f} {res['ns_per_op']:>12.0f} {ratio:>7.2f}{flag}", file=sys.stderr)
+    return regressions
+
+
+def main(suite: str, cases: list, argv: list = None):
+    parser = argparse.ArgumentParser(description=f"run {suite} benchmarks")
+    parser.add_argument('-k', '--filter', default='', help="only run cases whose name contains this")
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('-t', '--min-time', type=float, default=DEFAULT_MIN_TIME,
+                        help="minimum seconds per repeat")
+    parser.add_argument('-o', '--output', help="write json results to this file (default: stdout)")
+    parser.add_argument('-c', '--compare', help="json results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown reported as regression")
+    args = parser.parse_args(argv)
+
+    results = dict()
+    for case in cases:
+        if args.filter not in case.name:
+            continue
+        results[case.name] = run_case(case, args.repeat, args.min_time)
+        print(f"{case.name:<48} {results[case.name]['ns_per_op']:>14.0f} ns/op "
+              f"{results[case.name]['items_per_sec']:>16.0f} items/s", file=sys.stderr)
+
+    report = {
+        'suite': suite,
+        'revision': git_revision(),
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
@@ -1,165 +1,997 @@
-from datetime import datetime
 from rtmp_errors import *
-from rtmp_stream import StreamObject
+from rtmp_capture import CaptureWriter, CAPTURE_EXT
+from rtmp_client import RtmpClient, CLIENT_TIMEOUT
+from rtmp_hls import HLSSegmenter
+from rtmp_dvr import DVRBuffer, DVR_MAX_SIZE
+from rtmp_stream import StreamObject, HandshakeState, RelayState
 from rtmp_protocol import *
+from rtmp_logging import logger, ConnectionLogger
+from rtmp_metrics import render, start_metrics_server
+from rtmp_profiler import LoopProfiler, PROFILE_SECONDS, PROFILE_MAX_SECONDS
+from collections import deque
+from fnmatch import fnmatch
+from urllib.parse import parse_qs
+import errno
+import logging
 import socket
 import selectors
+import struct
 import os
 import uuid
 import time
 
+# a player whose socket does not take more than this is dropped instead of buffering forever
+MAX_SEND_PENDING = 16 * 1024 * 1024
+# time-shifted players are fed from the dvr buffer while they have less than this pending
+DVR_SEND_PENDING = 256 * 1024
+
+# admission control, connections over a limit are reset right after `accept`, before anything is allocated
+MAX_CONNECTIONS = 10000
+MAX_HANDSHAKES = 512  # connections between accept and an answered NetConnection.connect
+MAX_CONNECTIONS_PER_IP = 100
+ACCEPT_BATCH = 64  # connections accepted per readiness event of the listening socket
+LISTEN_BACKLOG = 1024
+HANDSHAKE_TIMEOUT = 10  # seconds from accept to connect
+HANDSHAKE_CHECK_INTERVAL = 1
+
+# a failed pull from the origin is retried after this, doubled on every failure in a row up to the max
+RELAY_RETRY_INTERVAL = 2
+RELAY_RETRY_MAX = 60
+
+# a ready socket is read until EAGAIN, or until this much was read in one turn of the loop.
+# what is left is read after every other ready socket had its turn, so a heavy publisher can't starve small ones
+READ_BUDGET = 512 * 1024
+# the parser keeps partial chunks pending, reads don't have to hold whole messages.
+# (`recv` allocates the full size before shrinking to what was read, don't ask for megabytes)
+RECV_SIZE = 128 * 1024
+
+# what malformed input from a peer raises in the parser and the handlers, the connection is dropped on these
+PROTOCOL_ERRORS = (RTMP_ProtocolError, RTMP_MultiplePacketsInBuffer, ValueError, IndexError, TypeError,
+                   struct.error)
+
 
 class RtmpBaseServer:
-    def __init__(self, addr: tuple, path: str):
+    def __init__(self, addr: tuple, path: str, metrics_addr=None, profile: bool = False, profile_dump: str = None,
+                 capture: bool = False, origin: tuple = None, edges: list = None, push: list = None, hls: bool = False,
+                 dvr: float = 0, dvr_size: int = DVR_MAX_SIZE, max_connections: int = MAX_CONNECTIONS,
+                 max_handshakes: int = MAX_HANDSHAKES, max_per_ip: int = MAX_CONNECTIONS_PER_IP,
+                 read_budget: int = READ_BUDGET):
+        """
+        :param addr: (host, port) to listen on
+        :param path: directory where stream directories are made
+        :param metrics_addr: optional (host, port) or unix socket path serving prometheus metrics
+        :param profile: time every loop callback, log stalls and allow sampling the loop (SIGUSR1, /profile)
+        :param profile_dump: file the sampled stacks are written to, in collapsed stack format
+        :param capture: record the raw bytes of every connection after the handshake into its stream directory,
+            see `test_features/rtmp_replay.py`
+        :param origin: (host, port) of the origin server. as an edge, keys not published here are pulled from it
+            when a player asks for them, one upstream connection per key whatever the number of players.
+            failed pulls are retried while players wait, backing off
+        :param edges: (host, port) list of edge servers published keys are pushed to.
+            give addresses, not names: a name would be resolved blocking the loop.
+            failed or dropped pushes are retried while the key is published, backing off
+        :param push: fnmatch patterns of the keys (`app/name`) pushed to `edges`, default every key
+        :param hls: remux published h264/aac into mpeg-ts segments and an `index.m3u8` in the publisher's directory
+        :param dvr: seconds of every published stream kept in memory (at most `dvr_size` bytes each).
+            players start that far behind live with `play('name?offset=<seconds>')`
+        :param max_connections: accepted connections, whatever their state
+        :param max_handshakes: connections being set up (handshake, connect) at once, so a reconnect storm
+            can't take the loop from established streams
+        :param max_per_ip: accepted connections from a single address
+        :param read_budget: bytes read from one connection per turn of the loop
+        """
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-        self.socket.setblocking(True)
+        self.socket.setblocking(False)
 
         self.addr = addr
-        self.sel = selectors.DefaultSelector()
+        # explicitly epoll where there is one, `DefaultSelector` may fall back to poll/select
+        self.sel = selectors.EpollSelector() if hasattr(selectors, 'EpollSelector') else selectors.DefaultSelector()
         self.clients = []
 
         self.streams = dict()
         self.save_path = path
 
+        # published stream keys (`app/name`) -> publishing StreamObject, and -> playing StreamObjects
+        self.publishers = dict()
+        self.players = dict()
+
+        self.metrics_addr = metrics_addr
+        self.metrics_server = None
+        self.profiler = LoopProfiler(dump_path=profile_dump) if profile else None
+        self.capture = capture
+
+        self.origin = origin
+        self.edges = edges or []
+        self.push = push
+        self.relays = dict()  # socket -> RelayState, from connect until publish/play is answered
+        self.pulling = dict()  # stream key -> upstream StreamObject being set up
+        self.pull_retry = dict()  # stream key -> (failures in a row, time.monotonic() of the next pull)
+        self.pushing = dict()  # (edge, stream key) -> downstream StreamObject, until its connection is closed
+        self.push_retry = dict()  # (edge, stream key) -> (failures in a row, time.monotonic() of the next push)
+        self.hls = hls
+        self.dvr = dvr
+        self.dvr_size = dvr_size
+
+        self.max_connections = max_connections
+        self.max_handshakes = max_handshakes
+        self.max_per_ip = max_per_ip
+        self.handshakes = dict()  # socket -> HandshakeState, from accept until connect is answered
+        self.client_ips = dict()  # accepted socket -> peer address
+        self.ip_counts = dict()  # peer address -> accepted connections
+        self.rejected = {'connections': 0, 'handshakes': 0, 'per_ip': 0}
+        self.next_expiry = 0
+        self.log = ConnectionLogger({'listen': f"{addr[0]}:{addr[1]}"})
+
+        self.read_budget = read_budget
+        self.ready = deque()  # sockets whose read budget ran out with data left, in turn order
+        self.requeued = 0
+
     def remove_client(self, sock: socket.socket):
-        sock.close()
         self.sel.unregister(sock)
+        sock.close()
         self.clients.remove(sock)
+        self.handshakes.pop(sock, None)
+        self.release_ip(sock)
+
+        stream = self.streams.pop(sock, None)
+        if stream is not None:
+            self.stop_stream(stream)
+            if stream.capture is not None:
+                stream.capture.close()
+            if stream.FLAG_RELAY:
+                self.push_closed(stream, "connection closed")
 
         return
 
     def recv(self, sock: socket.socket, sel: selectors.BaseSelector):
         stream = self.streams[sock]
+        if stream.FLAG_READ_PENDING:  # waiting for its turn in the ready queue
+            return
+
+        # drain the socket, up to the budget
+        budget = self.read_budget
+        while budget > 0:
+            size = min(RECV_SIZE, budget)
+            try:
+                data = sock.recv(size)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                stream.log.info("connection lost: %s", e)
+                self.remove_client(sock)
+                return
+            if not data:  # EOT packet
+                stream.log.info("received EOT")
+                self.remove_client(sock)
+                return
 
-        # check EOT
-        data = sock.recv((stream.max_size + 18) * 2)  # prepare for buffer stack..
-        if data:
-            print(f"[{datetime.now().isoformat()}] received data from ({sock.getpeername()}): length ({len(data)})")
+            stream.metrics.received(len(data))
+            if stream.capture is not None:
+                stream.capture.write(data)
+            stream.log.sampled('recv', logging.DEBUG, "received data: length (%d)", len(data))
             # call callback function
             self.recv_callback(data, sock)
-        else:  # EOT packet
-            print(f"[{datetime.now().isoformat()}] received EOT from ({sock.getpeername()}")
-            self.remove_client(sock)
+            if sock.fileno() == -1:  # closed by a message
+                return
+            if len(data) < size:
+                # short read, the socket is drained. if more came meanwhile, the selector reports it again
+                return
+            budget -= len(data)
+
+        # budget used up with data left, take the rest after the other ready sockets
+        stream.FLAG_READ_PENDING = True
+        self.ready.append(sock)
+        self.requeued += 1
+        return
+
+    def read_ready(self):
+        """one more turn for every socket requeued by `recv`, those still having data go to the back again"""
+        for _ in range(len(self.ready)):
+            sock = self.ready.popleft()
+            if sock.fileno() == -1:
+                continue
+            self.streams[sock].FLAG_READ_PENDING = False
+            self.dispatch(self.recv, sock)
+        return
 
     def accept(self, socket_obj: socket.socket, sel: selectors.BaseSelector):
-        client, addr = socket_obj.accept()
-        client.setblocking(True)
-        print(f"[{datetime.now().isoformat()}] starting handshake with ({addr[0]}:{addr[1]})...")
+        # drain the backlog, up to a budget so a connection storm can't hold the loop
+        for _ in range(ACCEPT_BATCH):
+            try:
+                client, addr = socket_obj.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:  # out of file descriptors..
+                self.log.sampled('accept', logging.WARNING, "accept failed: %s", e)
+                return
 
-        # >>> handshake
-        """
-        softwares like OBS sends c0+c1 together and expects to receive s0+s1 together... TF??
-        """
-        c1 = None
-        FLAG_c0c1 = False
-
-        # 1. receive c0
-        c0 = client.recv(1537)
-        if len(c0) == 1537:
-            # c0 + c1 received
-            c1 = c0[1:]
-            c0 = c0[0]
-            FLAG_c0c1 = True
-        elif len(c0) != 1:
-            print(f"received len ({len(c0)}). expecting c0(1) or c0+c1(1537). abort.")
-            self.remove_client(client)
-
-        if c0 != 3:
-            print(f"received ({c0}), expecting (3). trying to downgrade...")
-
-        # 2. receive c1
-        if c1 is None:
-            self.sel.select(1)
-            c1 = client.recv(1536)
-        if len(c1) != 1536 or c1[4:8] != b'\00' * 4:
-            print("not valid c1 packet. abort")
-            self.remove_client(client)
-            return
-        c1_time = c1[:4]
-        c1_random = c1[8:]
-
-        rand = os.urandom(1528)
-        # rand = b'\x00' * 1528
-        if FLAG_c0c1:
-            client.send(b'\x03' + b'\x00' * 4 + b'\x00' * 4 + rand)
-        else:
-            # 3. send s0
-            client.send(b'\x03')
+            ip = addr[0]
+            reason = self.admit(ip)
+            if reason is not None:
+                self.reject(client, ip, reason)
+                continue
 
-            # 4. send s1
-            client.send(b'\x00' * 4 + b'\x00' * 4 + rand)
+            client.setblocking(False)
+            self.client_ips[client] = ip
+            self.ip_counts[ip] = self.ip_counts.get(ip, 0) + 1
+            log = ConnectionLogger({'peer': f"{addr[0]}:{addr[1]}"})
+            log.info("starting handshake...")
+            self.handshakes[client] = HandshakeState(f"{addr[0]}:{addr[1]}", log,
+                                                     time.monotonic() + HANDSHAKE_TIMEOUT)
+            self.sel.register(client, selectors.EVENT_READ, self.handshake)
+        return
 
-        # 5. send s2
-        client.send(c1_time + b'\x00' * 4 + c1_random)
+    def admit(self, ip: str):
+        """name of the exceeded limit, None when a connection from `ip` can be accepted"""
+        if len(self.client_ips) >= self.max_connections:
+            return 'connections'
+        if len(self.handshakes) >= self.max_handshakes:
+            return 'handshakes'
+        if self.ip_counts.get(ip, 0) >= self.max_per_ip:
+            return 'per_ip'
+        return None
 
-        # 6. receive c2
-        c2 = client.recv(1536)
-        if len(c2) != 1536:
-            print("not a valid c2 packet. abort")
-            client.close()
-            return
-        if c2[8:] != rand or c2[0:4] != b'\00' * 4:
-            print("peer sent wrong echo for c2 packet. abort")
-            self.remove_client(client)
-            return
+    def reject(self, client: socket.socket, ip: str, reason: str):
+        # reset instead of a graceful close, nothing stays in TIME_WAIT on our side
+        try:
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+        client.close()
+        self.rejected[reason] += 1
+        self.log.sampled('reject', logging.WARNING, "rejecting connections over the (%s) limit, last from %s",
+                         reason, ip)
+        return
+
+    def release_ip(self, sock: socket.socket):
+        ip = self.client_ips.pop(sock, None)
+        if ip is not None:
+            count = self.ip_counts[ip] - 1
+            if count:
+                self.ip_counts[ip] = count
+            else:
+                del self.ip_counts[ip]
+        return
+
+    def drop_handshake(self, sock: socket.socket):
+        self.sel.unregister(sock)
+        sock.close()
+        self.handshakes.pop(sock, None)
+        self.release_ip(sock)
+        return
 
-        # <<<< handshake done
-        print(f"[{datetime.now().isoformat()}] handshake with ({addr[0]}:{addr[1]}) finished")
-        client.setblocking(False)
+    def expire_handshakes(self):
+        # connections which didn't get through handshake and connect in time, relays through their setup
+        now = time.monotonic()
+        self.next_expiry = now + HANDSHAKE_CHECK_INTERVAL
+        for sock, state in list(self.handshakes.items()):
+            if state.deadline < now:
+                state.log.warning("no connect after (%d) seconds. abort", HANDSHAKE_TIMEOUT)
+                if sock in self.streams:
+                    self.remove_client(sock)
+                else:
+                    self.drop_handshake(sock)
+        for sock, state in list(self.relays.items()):
+            if state.deadline < now:
+                self.relay_failed(sock, f"no answer after ({CLIENT_TIMEOUT}) seconds")
+        return
 
-        # >>> make stream object
+    def make_stream(self, sock: socket.socket, peer: str, log: ConnectionLogger):
         stream_id = uuid.uuid4().__str__()
-        stream_path = self.save_path + stream_id + "\\"
-        os.makedirs(stream_path)
-        stream = StreamObject(sock=client,
+        stream_path = os.path.join(self.save_path, stream_id)
+        os.makedirs(stream_path, exist_ok=True)
+        stream = StreamObject(sock=sock,
                               max_size=1024 * 1024,  # default 1MB, will be set in `start_stream`
                               stream_id=stream_id,
                               stream_path=stream_path,
                               start_time=time.time(),
+                              log=log.bind(stream_id=stream_id),
+                              peer=peer,
                               ack_window_size=1024 * 8,
                               sequence_size=1536 * 2 + 1)  # default 8k.. TODO check bandwidth
+        if self.capture:
+            stream.capture = CaptureWriter(os.path.join(stream_path, stream_id + CAPTURE_EXT), stream.peer)
+        return stream
 
-        self.start_stream(stream)
-        print(f"[{datetime.now().isoformat()}] stream made for ({addr[0]}:{addr[1]}) - stream id ({stream.stream_id})")
-        # <<< stream object made
+    def add_stream(self, stream: StreamObject):
+        # save stream object, its socket is served by the loop from now on
+        self.streams[stream.sock] = stream
+        self.clients.append(stream.sock)
+        self.sel.register(stream.sock, selectors.EVENT_READ, self.recv)
+        return
+
+    def handshake(self, sock: socket.socket, sel: selectors.BaseSelector):
+        """
+        non blocking rtmp handshake, called whenever handshake bytes arrive.
+        softwares like OBS sends c0+c1 together and expects to receive s0+s1 together, so s0+s1+s2 are sent at once
+        once c1 is received. the stream object is only made when the handshake succeeded.
+        """
+        state = self.handshakes[sock]
+        log = state.log
+        try:
+            data = sock.recv(1537 + 1536 - len(state.buffer))
+        except BlockingIOError:
+            return
+        except OSError as e:
+            log.warning("handshake failed: %s", e)
+            self.drop_handshake(sock)
+            return
+        if not data:
+            log.warning("peer closed the connection during handshake")
+            self.drop_handshake(sock)
+            return
+        state.buffer += data
 
-        # save stream object
-        self.streams[client] = stream
-        self.clients.append(client)
-        self.sel.register(client, selectors.EVENT_READ, self.recv)
+        # 1. receive c0 + c1
+        if state.rand is None:
+            if len(state.buffer) < 1537:
+                return
+            c0 = state.buffer[0]
+            c1 = bytes(state.buffer[1:1537])
+            del state.buffer[:1537]
+            if c0 != 3:
+                log.warning("received (%s), expecting (3). trying to downgrade...", c0)
+            if c1[4:8] != b'\00' * 4:
+                log.warning("not valid c1 packet. abort")
+                self.drop_handshake(sock)
+                return
 
+            # 2. send s0 + s1 + s2, a fresh socket buffer always takes them
+            state.rand = os.urandom(1528)
+            packet = b'\x03' + b'\x00' * 4 + b'\x00' * 4 + state.rand + c1[:4] + b'\x00' * 4 + c1[8:]
+            try:
+                sent = sock.send(packet)
+            except OSError as e:
+                sent = e
+            if sent != len(packet):
+                log.warning("could not send s0+s1+s2 (%s). abort", sent)
+                self.drop_handshake(sock)
+                return
+
+        # 3. receive c2
+        if len(state.buffer) < 1536:
+            return
+        c2 = state.buffer[:1536]
+        if c2[8:] != state.rand or c2[0:4] != b'\00' * 4:
+            log.warning("peer sent wrong echo for c2 packet. abort")
+            self.drop_handshake(sock)
+            return
+        rest = bytes(state.buffer[1536:])  # connect may come along with c2
+        state.buffer = None
+        log.info("handshake finished")
+
+        # >>> make stream object, waiting for connect (`on_connect`) from now on
+        self.sel.unregister(sock)
+        stream = self.make_stream(sock, state.peer, log)
+        self.add_stream(stream)
+        log.info("stream made")
+        # <<< stream object made
+
+        if rest:
+            stream.metrics.received(len(rest))
+            if stream.capture is not None:
+                stream.capture.write(rest)
+            self.recv_callback(rest, sock)
         return
 
     def recv_callback(self, data: bytes, sock: socket.socket):
         stream = self.streams[sock]
 
+        start = time.perf_counter()
         try:
-            chunk = RTMP(data, stream)
-            stream.FLAG_CHUNK_PENDING = False
-            stream.chunk_pending = bytes()
-        except RTMP_ChunkNotFullyReceived:
-            print(f"status: [pending] {stream.FLAG_CHUNK_PENDING}, [buffer] {stream.chunk_pending}")
-            stream.FLAG_CHUNK_PENDING = True
-            stream.chunk_pending += data
+            messages = RTMP().parse(data, stream)
+        except PROTOCOL_ERRORS as e:
+            stream.log.warning("malformed data from peer (%r). abort", e)
+            self.remove_client(sock)
+            return
+        stream.metrics.parsed(time.perf_counter() - start)
+        if stream.FLAG_CHUNK_PENDING:
+            stream.log.sampled('pending', logging.DEBUG, "status: [pending] %s, [buffer] (%d) bytes",
+                               stream.FLAG_CHUNK_PENDING, len(stream.chunk_pending))
+
+        for message in messages:
+            stream.metrics.message(message.header.chunk_type)
+            if sock.fileno() == -1:  # a previous message may have closed the connection
+                break
+            try:
+                self.handle_message(stream, message)
+            except PROTOCOL_ERRORS as e:
+                stream.log.warning("malformed message (type %d) from peer (%r). abort",
+                                   message.header.chunk_type, e)
+                self.remove_client(sock)
+                break
+
+    def handle_message(self, stream: StreamObject, message: RTMP):
+        mtype = message.header.chunk_type
+        if mtype == TYPE_AMF0_COMMAND:
+            self.handle_command(stream, message)
+        elif mtype in (TYPE_AUDIO, TYPE_VIDEO, TYPE_AMF0_DATA) and stream.FLAG_PUBLISH:
+            self.relay(stream, message)
+
+        return
+
+    def handle_command(self, stream: StreamObject, message: RTMP):
+        command = message.body.message.obj
+        if not command or not isinstance(command[0], bytes):
+            raise RTMP_ProtocolError(f"command name is not a string: {command[:1]}")
+        name = command[0].decode()
+        transaction_id = command[1] if len(command) > 1 and isinstance(command[1], float) else 0.0
+
+        if name == 'connect':
+            self.on_connect(stream, transaction_id, command)
+            return
+        if stream.sock in self.handshakes:
+            stream.log.warning("command (%s) before connect, ignored", name)
+            return
+
+        if name == 'createStream':
+            self.send(stream, RTMP().make_command(stream, COMMAND_RESULT, transaction_id, None,
+                                                  float(RTMP_STREAM_MID)))
+        elif name in ('publish', 'play'):
+            # publish/play(transaction id, null, stream name, ..)
+            stream_name = command[3].decode() if len(command) > 3 and isinstance(command[3], bytes) else ''
+            stream_name, _, query = stream_name.partition('?')
+            if name == 'publish':
+                self.start_publish(stream, transaction_id, f"{stream.app}/{stream_name}")
+            else:
+                try:
+                    offset = float(parse_qs(query).get('offset', [0])[0])
+                except ValueError:
+                    offset = 0
+                self.start_play(stream, transaction_id, f"{stream.app}/{stream_name}", offset)
+        elif name in ('deleteStream', 'closeStream', 'FCUnpublish'):
+            self.stop_stream(stream)
+        else:
+            # releaseStream, FCPublish, ... don't need an answer
+            stream.log.debug("ignoring command (%s)", name)
+
+        return
+
+    def on_status(self, stream: StreamObject, transaction_id: float, level: str, code: str, description: str):
+        self.send(stream, RTMP().make_command(stream, COMMAND_STATUS, transaction_id, None, {
+            'level': level,
+            'code': code,
+            'description': description,
+        }, mid=RTMP_STREAM_MID))
+        return
+
+    def start_publish(self, stream: StreamObject, transaction_id: float, stream_key: str):
+        if stream.FLAG_PUBLISH or stream.FLAG_PLAY:
+            # one stream per connection, what it published or played before stops
+            self.stop_stream(stream)
+        if stream_key in self.publishers:
+            stream.log.warning("(%s) is already published", stream_key)
+            self.on_status(stream, transaction_id, 'error', 'NetStream.Publish.BadName',
+                           f"{stream_key} is already published")
+            return
+
+        stream.stream_key = stream_key
+        stream.FLAG_PUBLISH = True
+        self.publishers[stream_key] = stream
+        stream.log.info("publishing (%s)", stream_key)
+
+        self.send(stream, RTMP().make_user_control(stream, USER_CONTROL_StreamBegin,
+                                                   struct.pack('>I', RTMP_STREAM_MID)))
+        self.on_status(stream, transaction_id, 'status', 'NetStream.Publish.Start', f"{stream_key} is published")
+        self.start_outputs(stream)
+
+        if self.edges and (self.push is None or any(fnmatch(stream_key, p) for p in self.push)):
+            for edge in self.edges:
+                self.push_relay(edge, stream)
+        return
+
+    def start_outputs(self, stream: StreamObject):
+        # what a publisher's media goes to, besides its players
+        if self.hls:
+            stream.hls = HLSSegmenter(stream.stream_path, stream.log).start()
+        if self.dvr:
+            stream.dvr = DVRBuffer(self.dvr, self.dvr_size)
+        return
+
+    def start_play(self, stream: StreamObject, transaction_id: float, stream_key: str, offset: float = 0):
+        """:param offset: seconds behind live, when the publisher keeps a dvr buffer"""
+        if stream.FLAG_PUBLISH or stream.FLAG_PLAY:
+            self.stop_stream(stream)
+        stream.stream_key = stream_key
+        stream.FLAG_PLAY = True
+        self.players.setdefault(stream_key, []).append(stream)
+        stream.log.info("playing (%s)", stream_key)
+
+        self.send(stream, RTMP().make_user_control(stream, USER_CONTROL_StreamBegin,
+                                                   struct.pack('>I', RTMP_STREAM_MID)))
+        self.on_status(stream, transaction_id, 'status', 'NetStream.Play.Reset', f"playing {stream_key}")
+        self.on_status(stream, transaction_id, 'status', 'NetStream.Play.Start', f"playing {stream_key}")
+
+        publisher = self.publishers.get(stream_key)
+        if publisher is None and self.origin is not None:
+            # the upstream sends metadata and sequence headers itself, to every player of the key.
+            # while a pull is being set up or waits for its retry, players of the key just wait for it
+            if stream_key not in self.pulling and stream_key not in self.pull_retry:
+                self.pull_relay(stream_key, stream.app)
+        elif publisher is not None:
+            self.send_config(stream, publisher)
+
+            if offset > 0 and publisher.dvr is not None:
+                stream.dvr_cursor = publisher.dvr.seek(publisher.dvr.live - int(offset * 1000))
+                if stream.dvr_cursor is not None:
+                    stream.log.info("playing (%s) from %.1fs behind live", stream_key,
+                                    (publisher.dvr.live - publisher.dvr.get(stream.dvr_cursor)[1]) / 1000)
+                    self.feed_dvr(stream, publisher.dvr)
+        return
+
+    def send_config(self, player: StreamObject, publisher: StreamObject):
+        # players can't decode anything before metadata and sequence headers
+        for mtype, data in ((TYPE_AMF0_DATA, publisher.metadata),
+                            (TYPE_VIDEO, publisher.video_config),
+                            (TYPE_AUDIO, publisher.audio_config)):
+            if data is not None:
+                self.send(player, RTMP().make_media(mtype, 0, data, player.max_size))
+        return
+
+    def feed_dvr(self, player: StreamObject, dvr: DVRBuffer):
+        """
+        send a time-shifted player what its socket takes of the dvr buffer, from its cursor.
+        called again when its queue drains and on every live message, the player is live again once caught up
+        """
+        sent = 0
+        while player.dvr_cursor is not None and len(player.send_pending) < DVR_SEND_PENDING \
+                and sent < DVR_SEND_PENDING and player.sock.fileno() != -1:
+            if player.dvr_cursor == dvr.end:
+                player.dvr_cursor = None
+                player.log.info("caught up with live")
+                break
+            if player.dvr_cursor < dvr.first:
+                # evicted under the player's feet, skip to what is left
+                player.dvr_cursor = dvr.seek(dvr.oldest)
+                player.log.sampled('dvr-evicted', logging.WARNING, "player is behind the dvr window, skipping")
+                if player.dvr_cursor is None:
+                    player.dvr_cursor = dvr.end
+                continue
+
+            mtype, timestamp, data = dvr.get(player.dvr_cursor)
+            self.send(player, RTMP().make_media(mtype, timestamp, data, player.max_size))
+            player.dvr_cursor += 1
+            sent += len(data)
+        return
+
+    def stop_stream(self, stream: StreamObject):
+        """stop publishing or playing, called on deleteStream and when the connection is removed"""
+        key = stream.stream_key
+        if stream.FLAG_PUBLISH and self.publishers.get(key) is stream:
+            del self.publishers[key]
+            stream.log.info("stopped publishing (%s)", key)
+            if stream.hls is not None:
+                stream.hls.close()
+                stream.hls = None
+            stream.dvr = None
+            for player in list(self.players.get(key, [])):
+                player.dvr_cursor = None
+                if player.FLAG_RELAY:
+                    # frees the key on the edge, for the next publisher
+                    self.remove_client(player.sock)
+                else:
+                    self.send(player, RTMP().make_user_control(player, USER_CONTROL_StreamEOF,
+                                                               struct.pack('>I', RTMP_STREAM_MID)))
+        if stream.FLAG_PLAY and stream in self.players.get(key, []):
+            self.players[key].remove(stream)
+            if not self.players[key]:
+                del self.players[key]
+                publisher = self.publishers.get(key)
+                if publisher is not None and publisher.FLAG_RELAY:
+                    publisher.log.info("no player left for (%s), closing the upstream", key)
+                    self.remove_client(publisher.sock)
+
+        stream.FLAG_PUBLISH = False
+        stream.FLAG_PLAY = False
+        return
+
+    def open_relay(self, addr: tuple, stream_key: str, app: str, publish: bool):
+        """
+        start connecting to another server, to publish or play `stream_key` there.
+        non blocking like the handshake, setup runs from the selector (`relay_connect`, `relay_setup`)
+        and `push_ready`/`pull_ready` take the connection over. returns its StreamObject, None on failure
+        """
+        peer = f"{addr[0]}:{addr[1]}"
+        log = ConnectionLogger({'peer': peer, 'relay': 'push' if publish else 'pull'})
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        try:
+            err = sock.connect_ex(addr)
+        except OSError as e:
+            err = e.errno
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            log.warning("relay connection failed: %s", os.strerror(err) if err else 'unknown error')
+            sock.close()
+            return None
+
+        stream = self.make_stream(sock, peer, log)
+        stream.FLAG_RELAY = True
+        stream.app = app
+        stream.stream_key = stream_key
+        self.relays[sock] = RelayState(RtmpClient(sock, stream, app), stream_key[len(app) + 1:], publish,
+                                       time.monotonic() + CLIENT_TIMEOUT)
+        self.sel.register(sock, selectors.EVENT_WRITE, self.relay_connect)
+        return stream
+
+    def relay_connect(self, sock: socket.socket, sel: selectors.BaseSelector):
+        """the relay socket is connected (or failed to), send c0 + c1"""
+        state = self.relays[sock]
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.relay_failed(sock, os.strerror(err))
+            return
+        try:
+            packet = state.client.begin(state.stream_name, state.publish)
+            sent = sock.send(packet)  # a fresh socket buffer always takes them
+        except OSError as e:
+            self.relay_failed(sock, str(e))
+            return
+        if sent != len(packet):
+            self.relay_failed(sock, f"could not send c0+c1 ({sent})")
+            return
+        self.sel.modify(sock, selectors.EVENT_READ, self.relay_setup)
+        return
+
+    def relay_setup(self, sock: socket.socket, sel: selectors.BaseSelector):
+        """called whenever setup bytes arrive, answers are sent as the client goes through its steps"""
+        state = self.relays[sock]
+        client = state.client
+        try:
+            data = sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.relay_failed(sock, str(e))
+            return
+        if not data:
+            self.relay_failed(sock, "peer closed the connection")
+            return
+
+        try:
+            packet = client.feed(data)
+            # setup messages are small, the socket takes them like the handshake
+            if packet and sock.send(packet) != len(packet):
+                raise ConnectionError("could not send setup messages")
+        except (OSError,) + PROTOCOL_ERRORS as e:
+            self.relay_failed(sock, repr(e))
+            return
+        if not client.FLAG_READY:
+            return
+
+        # >>> set up, served by the loop from now on
+        del self.relays[sock]
+        self.sel.unregister(sock)
+        self.add_stream(client.stream)
+        if state.publish:
+            self.push_ready(client.stream)
+        else:
+            self.pull_ready(client.stream, client.backlog)
+        return
+
+    def drop_relay(self, sock: socket.socket):
+        state = self.relays.pop(sock)
+        self.sel.unregister(sock)
+        sock.close()
+        stream = state.client.stream
+        if stream.capture is not None:
+            stream.capture.close()
+        else:
+            # failed pulls are retried, don't leave an empty directory for every attempt
+            try:
+                os.rmdir(stream.stream_path)
+            except OSError:
+                pass
+        return state
+
+    def relay_failed(self, sock: socket.socket, reason: str):
+        state = self.drop_relay(sock)
+        stream = state.client.stream
+        if state.publish:
+            self.push_closed(stream, reason)
+            return
+
+        self.pulling.pop(stream.stream_key, None)
+        self.pull_failed(stream.stream_key, stream.log, reason)
+        return
+
+    def relay_retry(self, retries: dict, key, stream_key: str, log: ConnectionLogger, reason: str):
+        """one more failure of the relay `key` in `retries`, it is retried later, backing off"""
+        failures = retries.get(key, (0, 0))[0] + 1
+        delay = min(RELAY_RETRY_INTERVAL * 2 ** (failures - 1), RELAY_RETRY_MAX)
+        retries[key] = (failures, time.monotonic() + delay)
+        log.warning("relay of (%s) failed: %s. retrying in (%d) seconds", stream_key, reason, delay)
+        return
+
+    def pull_failed(self, stream_key: str, log: ConnectionLogger, reason: str):
+        # players of the key keep waiting, the pull is retried later
+        self.relay_retry(self.pull_retry, stream_key, stream_key, log, reason)
+        return
+
+    def retry_pulls(self):
+        now = time.monotonic()
+        for key, (failures, retry_at) in list(self.pull_retry.items()):
+            players = self.players.get(key)
+            if not players or key in self.publishers:
+                # nobody waits anymore, or published here meanwhile
+                del self.pull_retry[key]
+            elif retry_at <= now and key not in self.pulling:
+                self.pull_relay(key, players[0].app)
+        return
+
+    def pull_relay(self, stream_key: str, app: str):
+        """play `stream_key` from the origin and publish it here, for every local player of the key"""
+        upstream = self.open_relay(self.origin, stream_key, app, publish=False)
+        if upstream is None:
+            self.pull_failed(stream_key, self.log, "could not connect to the origin")
+            return
+        self.pulling[stream_key] = upstream
+        return
+
+    def pull_ready(self, upstream: StreamObject, backlog: list):
+        key = upstream.stream_key
+        self.pulling.pop(key, None)
+        self.pull_retry.pop(key, None)
+        if key in self.publishers or not self.players.get(key):
+            upstream.log.info("(%s) is published here or has no player left, closing the upstream", key)
+            self.remove_client(upstream.sock)
+            return
+
+        upstream.FLAG_PUBLISH = True
+        self.publishers[key] = upstream
+        upstream.log.info("pulling (%s)", key)
+        self.start_outputs(upstream)
+
+        # metadata and sequence headers sent right after NetStream.Play.Start
+        for message in backlog:
+            if upstream.sock.fileno() == -1:
+                break
+            try:
+                self.handle_message(upstream, message)
+            except PROTOCOL_ERRORS as e:
+                upstream.log.warning("malformed message from the origin (%r). abort", e)
+                self.remove_client(upstream.sock)
+        return
+
+    def push_relay(self, addr: tuple, stream: StreamObject):
+        """publish `stream` to the edge at `addr`, the connection is fed like a local player once set up"""
+        if (addr, stream.stream_key) in self.pushing:
+            return
+        downstream = self.open_relay(addr, stream.stream_key, stream.app, publish=True)
+        if downstream is None:
+            self.relay_retry(self.push_retry, (addr, stream.stream_key), stream.stream_key, stream.log,
+                             f"could not connect to the edge {addr[0]}:{addr[1]}")
+            return
+        self.pushing[(addr, stream.stream_key)] = downstream
+        return
+
+    def push_closed(self, downstream: StreamObject, reason: str):
+        """the connection of a push is closed, during setup or afterwards. retried while the key is published"""
+        for push, stream in self.pushing.items():
+            if stream is downstream:
+                break
+        else:
+            return  # an upstream, or a push not tracked anymore
+        del self.pushing[push]
+        if push[1] not in self.publishers:
+            downstream.log.info("stopped pushing (%s)", push[1])
+            return
+        self.relay_retry(self.push_retry, push, push[1], downstream.log, reason)
+        return
+
+    def retry_pushes(self):
+        now = time.monotonic()
+        for push, (failures, retry_at) in list(self.push_retry.items()):
+            edge, key = push
+            publisher = self.publishers.get(key)
+            if publisher is None:
+                # nothing to push anymore
+                del self.push_retry[push]
+            elif retry_at <= now and push not in self.pushing:
+                self.push_relay(edge, publisher)
+        return
+
+    def push_ready(self, downstream: StreamObject):
+        key = downstream.stream_key
+        publisher = self.publishers.get(key)
+        if publisher is None:
+            downstream.log.info("(%s) is not published anymore, closing the downstream", key)
+            self.remove_client(downstream.sock)
+            return
+        for push, stream in self.pushing.items():
+            if stream is downstream:
+                self.push_retry.pop(push, None)
+                break
+
+        downstream.FLAG_PLAY = True
+        self.players.setdefault(key, []).append(downstream)
+        downstream.log.info("pushing (%s)", key)
+        # the publisher may have sent them while the relay was set up
+        self.send_config(downstream, publisher)
+        return
+
+    def relay(self, stream: StreamObject, message: RTMP):
+        mtype = message.header.chunk_type
+        data = message.body.data
+
+        # keep what late players need before the first frame
+        if mtype == TYPE_VIDEO and len(data) > 1 and data[0] & 0x0f == FLV_CODEC_AVC \
+                and data[1] == FLV_AVC_SEQUENCE_HEADER:
+            stream.video_config = bytes(data)
+        elif mtype == TYPE_AUDIO and len(data) > 1 and data[0] >> 4 == FLV_CODEC_AAC \
+                and data[1] == FLV_AAC_SEQUENCE_HEADER:
+            stream.audio_config = bytes(data)
+        elif mtype == TYPE_AMF0_DATA and message.body.message.command == DATA_SET_DATA_FRAME:
+            data = stream.metadata
+        if stream.hls is not None and mtype != TYPE_AMF0_DATA:
+            stream.hls.feed(mtype, message.header.timestamp, data)
+        if stream.dvr is not None and mtype != TYPE_AMF0_DATA:
+            stream.dvr.append(mtype, message.header.timestamp, data,
+                              mtype == TYPE_VIDEO and len(data) > 0 and data[0] >> 4 == FLV_FRAME_KEY)
+
+        players = self.players.get(stream.stream_key)
+        if not players:
+            return
+
+        # every player gets the same bytes unless it uses another chunk size
+        compiled = dict()
+        for player in list(players):
+            if player.dvr_cursor is not None:
+                # time-shifted, this message is in the dvr buffer already
+                self.feed_dvr(player, stream.dvr)
+                continue
+            packet = compiled.get(player.max_size)
+            if packet is None:
+                packet = compiled[player.max_size] = RTMP().make_media(mtype, message.header.timestamp, data,
+                                                                       player.max_size)
+            self.send(player, packet)
+
+        return
 
     def run(self):
         self.socket.bind(self.addr)
-        self.socket.listen()
-        print(f"[*] server listening on {self.addr[0]}:{self.addr[1]}")
+        self.socket.listen(LISTEN_BACKLOG)
+        logger.info("server listening on %s:%d", self.addr[0], self.addr[1])
 
         self.sel.register(self.socket, selectors.EVENT_READ, self.accept)
+        if self.metrics_addr is not None:
+            self.metrics_server = start_metrics_server(self.metrics_addr, self.collect_metrics,
+                                                       {'/profile': self.profile_command})
+            logger.info("serving metrics on %s", self.metrics_addr)
+        if self.profiler is not None:
+            self.profiler.start()
 
         while True:
-            events = self.sel.select(-1)
-            for key, _ in events:
-                callback = key.data
-                callback(key.fileobj, self.sel)
+            # don't wait while requeued sockets have data left. otherwise wake up now and then while
+            # connections are being set up, to expire stale ones, and while relays wait for their retry
+            timers = self.handshakes or self.relays or self.pull_retry or self.push_retry
+            if self.ready:
+                timeout = 0
+            elif timers:
+                timeout = HANDSHAKE_CHECK_INTERVAL
+            else:
+                timeout = None
+            events = self.sel.select(timeout)
+            if timers and time.monotonic() >= self.next_expiry:
+                self.expire_handshakes()
+                self.retry_pulls()
+                self.retry_pushes()
+            for key, mask in events:
+                # a callback may have closed a socket having an event in this batch
+                if mask & selectors.EVENT_WRITE and key.fileobj.fileno() != -1:
+                    # streams wait for writing to flush what is pending, relays being set up to be connected
+                    self.dispatch(self.flush if key.data == self.recv else key.data, key.fileobj)
+                if mask & selectors.EVENT_READ and key.fileobj.fileno() != -1:
+                    self.dispatch(key.data, key.fileobj)
+            if self.ready:
+                self.read_ready()
+
+    def dispatch(self, callback, fileobj):
+        if self.profiler is None:
+            callback(fileobj, self.sel)
+        else:
+            self.profiler.call(callback, fileobj, self.sel)
+        return
+
+    def collect_metrics(self):
+        # called from the metrics thread, take a copy of the streams first
+        res = render(list(self.streams.values()))
+        res += '\n'.join([
+            '# HELP rtmp_connections accepted connections',
+            '# TYPE rtmp_connections gauge',
+            f'rtmp_connections {len(self.client_ips)}',
+            '# HELP rtmp_handshakes connections between accept and connect',
+            '# TYPE rtmp_handshakes gauge',
+            f'rtmp_handshakes {len(self.handshakes)}',
+            '# HELP rtmp_reads_requeued_total reads stopped by the read budget with data left',
+            '# TYPE rtmp_reads_requeued_total counter',
+            f'rtmp_reads_requeued_total {self.requeued}',
+            '# HELP rtmp_connections_rejected_total connections reset at accept, by exceeded limit',
+            '# TYPE rtmp_connections_rejected_total counter',
+        ] + [f'rtmp_connections_rejected_total{{reason="{k}"}} {v}' for k, v in list(self.rejected.items())]) + '\n'
+        if self.profiler is not None:
+            res += self.profiler.render()
+        return res
+
+    def profile_command(self, query: dict):
+        # GET /profile?seconds=N
+        if self.profiler is None:
+            return "profiling is not enabled\n"
+        try:
+            seconds = float(query.get('seconds', [PROFILE_SECONDS])[0])
+        except ValueError:
+            raise ValueError("seconds should be a number")
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:  # nan too
+            raise ValueError(f"seconds should be in (0, {PROFILE_MAX_SECONDS}]")
+        if not self.profiler.start_sampling(seconds):
+            return "sampling is already running\n"
+        return f"sampling for {seconds} seconds\n"
+
+    def send(self, stream: StreamObject, data: bytes):
+        """send or queue `data`, whatever the socket does not take now is sent when it is writable"""
+        sock = stream.sock
+        if sock.fileno() == -1:
+            return 0
+
+        if stream.send_pending:
+            stream.send_pending += data
+            sent = 0
+        else:
+            try:
+                sent = sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError as e:
+                stream.log.info("connection lost: %s", e)
+                self.remove_client(sock)
+                return 0
+            stream.metrics.sent(sent)
+            if sent < len(data):
+                stream.send_pending += data[sent:]
+                self.sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self.recv)
+
+        if len(stream.send_pending) > MAX_SEND_PENDING:
+            stream.log.warning("peer is too slow, (%d) bytes pending. abort", len(stream.send_pending))
+            self.remove_client(sock)
+        return sent
+
+    def flush(self, sock: socket.socket, sel: selectors.BaseSelector):
+        stream = self.streams[sock]
+        try:
+            sent = sock.send(stream.send_pending)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            stream.log.info("connection lost: %s", e)
+            self.remove_client(sock)
+            return
+
+        stream.metrics.sent(sent)
+        del stream.send_pending[:sent]
+        if not stream.send_pending:
+            self.sel.modify(sock, selectors.EVENT_READ, self.recv)
+        if stream.dvr_cursor is not None and len(stream.send_pending) < DVR_SEND_PENDING:
+            publisher = self.publishers.get(stream.stream_key)
+            if publisher is not None and publisher.dvr is not None:
+                self.feed_dvr(stream, publisher.dvr)
+        return
 
     def close(self):
-        for c in self.clients:
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+
+        for c in self.clients[:]:
             self.remove_client(c)
+        for c in list(self.handshakes):
+            if c.fileno() != -1:
+                self.drop_handshake(c)
+        for c in list(self.relays):
+            self.drop_relay(c)
 
         self.sel.unregister(self.socket)
         self.sel.close()
@@ -173,49 +1005,51 @@ class RtmpBaseServer:
 
         return
 
-    def start_stream(self, stream: StreamObject):
-        sock = stream.sock
-        sock.setblocking(True)
-
+    def on_connect(self, stream: StreamObject, transaction_id: float, command: list):
         # connect >>>>>
+        if self.handshakes.pop(stream.sock, None) is None:
+            stream.log.warning("connect received twice, ignored")
+            return
 
-        # 1. receive control message
-        packet = sock.recv(stream.max_size)
-        r = RTMP()
-        p1, p2 = r.parse(packet, stream)
-
-        # 2. receive command message (NetConnection.connect)
-        connect_message = p2
-        print(p2.header.__dict__)
-        print(p2.body.__dict__)
+        # 1-2. control messages before connect went through the parser, read the connect properties
+        stream.log.debug("connect: %s", command)
+        properties = command[2] if len(command) > 2 and isinstance(command[2], dict) else dict()
+        app = properties.get(b'app', b'')
+        stream.app = app.decode().strip('/') if isinstance(app, bytes) else ''
 
         # 3. send window ack
         # TODO check buffer size and bandwidth
         packet = RTMP()
-        sock.send(
-            packet.make_window_ack(stream=stream, size=stream.max_size * 2)
+        self.send(
+            stream, packet.make_window_ack(stream=stream, size=stream.max_size * 2)
         )
 
         # 4. send bandwidth
         # TODO check bandwidth
         packet = RTMP()
-        sock.send(packet.make_control_set_chunk(stream=stream, size=stream.max_size))
+        self.send(stream, packet.make_peer_bandwidth(stream=stream, size=stream.max_size * 2))
 
-        # 5. receive window ack
-        packet = stream.sock.recv(stream.max_size)
+        # 5. send chunk size, every message we send is chunked by `max_size`
+        packet = RTMP()
+        self.send(stream, packet.make_control_set_chunk(stream=stream, size=stream.max_size))
 
         # 6. send user control message
         packet = RTMP()
-        sock.send(packet)
+        self.send(stream, packet.make_user_control(stream=stream, event=USER_CONTROL_StreamBegin,
+                                                   data=struct.pack('>I', 0)))
 
         # 7. send command message (_result)
         packet = RTMP()
-        sock.send(packet)
+        self.send(stream, packet.make_command(stream, COMMAND_RESULT, transaction_id, {
+            'fmsVer': 'FMS/3,0,1,123',
+            'capabilities': 31.0,
+        }, {
+            'level': 'status',
+            'code': 'NetConnection.Connect.Success',
+            'description': 'Connection succeeded.',
+            'objectEncoding': 0.0,
+        }))
 
         # <<< connect finish
-        # startStream >>>>
-
-        # <<<startStream finish
-
-        sock.setblocking(False)
+        # createStream/publish/play are handled in `handle_command`, some peers send them with connect
         return
@@ -0,0 +1,150 @@
+"""
+raw ingest capture.
+every buffer a connection hands to the parser after the handshake is written as it was received,
+with the time of the `recv` call, so a session can be parsed again offline exactly as it was.
+the network loop only queues buffers, files are written by a writer thread shared by every capture.
+
+file layout (big endian):
+    header:  magic (8) | start time, unix seconds (double) | peer length (H) | peer (utf-8)
+    records: offset from start, ns (Q) | length (I) | data
+"""
+from rtmp_logging import logger, ConnectionLogger
+import logging
+import queue
+import struct
+import threading
+import time
+
+CAPTURE_MAGIC = b'RTMPCAP\x01'
+CAPTURE_EXT = '.rtmpcap'
+
+HEADER = struct.Struct('>dH')
+RECORD = struct.Struct('>QI')
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+# bytes queued for the writer thread, over all captures. a capture falling behind stops recording
+# instead of growing memory: a record missing in the middle could not be parsed past anyway
+CAPTURE_MAX_PENDING = 64 * 1024 * 1024
+
+
+class CaptureQueue:
+    """
+    writer thread shared by every capture, the network loop only queues buffers.
+    `queued` is only updated by the loop and `written` only by the writer, the difference is what is pending
+    """
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.queued = 0
+        self.written = 0
+        self.thread = None
+        self.log = ConnectionLogger({'thread': 'capture'})
+
+    def put(self, capture, data):
+        """
+        queue `data` (tuple of bytes) for `capture`, or None to close its file.
+        returns False when too much is pending, closing never fails
+        """
+        if data is not None:
+            size = sum(len(_) for _ in data)
+            if self.queued - self.written + size > CAPTURE_MAX_PENDING:
+                return False
+            self.queued += size
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="capture", daemon=True)
+            self.thread.start()
+        self.queue.put((capture, data))
+        return True
+
+    def run(self):
+        while True:
+            capture, data = self.queue.get()
+            try:
+                if capture.file is None:
+                    capture.file = open(capture.path, 'wb', buffering=WRITE_BUFFER_SIZE)
+                if data is None:
+                    capture.file.close()
+                else:
+                    for _ in data:
+                        capture.file.write(_)
+            except (OSError, ValueError) as e:  # disk full, file closed after a failed write..
+                self.log.sampled('io', logging.WARNING, "capture (%s) failed: %s", capture.path, e)
+            finally:
+                if data is not None:
+                    self.written += sum(len(_) for _ in data)
+
+
+WRITER = CaptureQueue()
+
+
+class CaptureWriter:
+    """
+    recording of a single connection. `write` and `close` are called from the network loop,
+    the file is opened and written by the shared writer thread
+    """
+    __slots__ = ('path', 'file', 'start', 'records', 'size', 'FLAG_CLOSED')
+
+    def __init__(self, path: str, peer: str = ''):
+        self.path = path
+        self.file = None  # opened by the writer thread
+        self.start = time.monotonic_ns()
+        self.records = 0
+        self.size = 0
+        self.FLAG_CLOSED = False
+
+        peer = peer.encode()
+        self.queue(CAPTURE_MAGIC + HEADER.pack(time.time(), len(peer)) + peer)
+
+    def queue(self, *data):
+        if not WRITER.put(self, data):
+            logger.warning("capture (%s) is too far behind, (%d) records written. stopping it",
+                           self.path, self.records)
+            self.close()
+
+    def write(self, data: bytes):
+        """record one buffer as returned by `recv`"""
+        if self.FLAG_CLOSED:
+            return
+        self.queue(RECORD.pack(time.monotonic_ns() - self.start, len(data)), data)
+        self.records += 1
+        self.size += len(data)
+
+    def close(self):
+        if self.FLAG_CLOSED:
+            return
+        self.FLAG_CLOSED = True
+        WRITER.put(self, None)
+
+
+class CaptureReader:
+    """iterates (offset in seconds, data) of every recorded buffer, in order"""
+    __slots__ = ('file', 'start_time', 'peer')
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        if self.file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            self.file.close()
+            raise ValueError(f"{path} is not a capture file")
+        self.start_time, peer_len = HEADER.unpack(self.file.read(HEADER.size))
+        self.peer = self.file.read(peer_len).decode()
+
+    def __iter__(self):
+        read = self.file.read
+        while True:
+            record = read(RECORD.size)
+            if len(record) < RECORD.size:
+                # end of file, or the server died in the middle of a record
+                return
+            offset, length = RECORD.unpack(record)
+            data = read(length)
+            if len(data) < length:
+                return
+            yield offset / 1e9, data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
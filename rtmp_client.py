@@ -0,0 +1,168 @@
+from rtmp_stream import StreamObject
+from rtmp_protocol import *
+import socket
+import struct
+import os
+
+# setup (handshake, connect, createStream, publish/play) must not wait forever for a dead peer
+CLIENT_TIMEOUT = 5
+CLIENT_RECV_SIZE = 64 * 1024
+FLASH_VER = 'FMLE/3.0 (compatible; rtmp_client)'
+
+
+class RtmpClient:
+    """
+    client side of a rtmp session, on a connected socket.
+    setup is a sequence of steps driven by the bytes received, it can run either way:
+    - non blocking: `begin` returns c0+c1, `feed` takes what was received and returns what to send next,
+        until `FLAG_READY`. the server's selector drives relays like this
+    - blocking: `connect`, then `publish` or `play`. used by test clients
+    afterwards the socket is handed over to an event loop: the server's selector for relays,
+    the scaffolding's watcher thread for test clients.
+    every message received during setup which does not answer a command is kept in `backlog`,
+    it has to be handled by whoever takes the socket over.
+    """
+    def __init__(self, sock: socket.socket, stream: StreamObject, app: str, timeout: float = CLIENT_TIMEOUT):
+        """
+        :param stream: parser state of the connection. `stream.max_size` is the chunk size used for sending
+        """
+        self.socket = sock
+        self.stream = stream
+        self.app = app
+        self.timeout = timeout
+        self.backlog = []
+        self.transaction_id = 0.0
+
+        self.c1 = None  # set from `begin` until the handshake is done
+        self.buffer = None  # handshake bytes received so far
+        self.steps = []  # (name, args, message stream id) of the commands left to send
+        self.pending = None  # (name, transaction id) of the command waiting for its answer
+        self.FLAG_READY = False
+
+    def begin(self, stream_name: str = None, publish: bool = False):
+        """
+        c0 + c1, the first bytes to send. setup goes on up to createStream,
+        then to publish or play `stream_name` when given
+        """
+        host, port = self.socket.getpeername()[:2]
+        self.steps = [
+            ('connect', ({
+                'app': self.app,
+                'type': 'nonprivate',
+                'flashVer': FLASH_VER,
+                'tcUrl': f"rtmp://{host}:{port}/{self.app}",
+            },), RTMP_CONTROL_MID),
+            ('createStream', (None,), RTMP_CONTROL_MID),
+        ]
+        if stream_name is not None:
+            self.steps.append(self.action(stream_name, publish))
+        self.FLAG_READY = False
+
+        self.c1 = struct.pack('>II', 0, 0) + os.urandom(1528)
+        self.buffer = bytearray()
+        return b'\x03' + self.c1  # c0 + c1, like OBS
+
+    def action(self, stream_name: str, publish: bool):
+        if publish:
+            return 'publish', (None, stream_name, 'live'), RTMP_STREAM_MID
+        return 'play', (None, stream_name), RTMP_STREAM_MID
+
+    def feed(self, data: bytes):
+        """
+        process bytes received during setup, returns the bytes to send (may be empty).
+        raises ConnectionError when the server refuses, and whatever the parser raises on malformed input
+        """
+        res = []
+        if self.c1 is not None:
+            self.buffer += data
+            if len(self.buffer) < 1 + 1536 * 2:
+                return b''
+            s012 = bytes(self.buffer[:1 + 1536 * 2])
+            data = bytes(self.buffer[1 + 1536 * 2:])
+            if s012[1 + 1536 + 8:] != self.c1[8:]:
+                raise ConnectionError("server sent wrong echo for s2")
+            self.c1 = None
+            self.buffer = None
+            res.append(s012[1:1 + 1536])  # c2: echo of s1
+            res.append(RTMP().make_control_set_chunk(self.stream, self.stream.max_size))
+            res.append(self.next_command())
+            if not data:
+                return b''.join(res)
+
+        self.stream.metrics.received(len(data))
+        if self.stream.capture is not None:
+            self.stream.capture.write(data)
+        for message in RTMP().parse(data, self.stream):
+            # messages following the last answer in the same buffer (metadata..) are not ours either
+            if self.pending is not None and message.header.chunk_type == TYPE_AMF0_COMMAND:
+                answered = self.answer(message.body.message.obj)
+                if answered:
+                    res.append(self.next_command())
+                if answered is not None:
+                    continue
+            self.backlog.append(message)
+        return b''.join(res)
+
+    def answer(self, res: list):
+        """
+        whether `res` answers the pending command: True when it does, False when it is a status
+        of the pending command to skip, None when it is not ours
+        """
+        name, transaction_id = self.pending
+        if len(res) < 2 or not (res[0] in (b'_result', b'_error') and res[1] == transaction_id or
+                                res[0] == b'onStatus' and name in ('publish', 'play')):
+            return None
+        info = res[3] if len(res) > 3 and isinstance(res[3], dict) else dict()
+        if res[0] == b'_error' or res[0] == b'onStatus' and info.get(b'level') == b'error':
+            raise ConnectionError(f"({name}) failed: {res}")
+        # NetStream.Play.Reset comes before NetStream.Play.Start
+        code = info.get(b'code')
+        if res[0] == b'onStatus' and not (isinstance(code, bytes) and code.endswith(b'Start')):
+            return False
+        return True
+
+    def next_command(self):
+        """the next setup command, or b'' once every command was answered"""
+        if not self.steps:
+            self.pending = None
+            self.FLAG_READY = True
+            return b''
+        name, args, mid = self.steps.pop(0)
+        self.transaction_id += 1
+        self.pending = (name, self.transaction_id)
+        return RTMP().make_command(self.stream, name, self.transaction_id, *args, mid=mid)
+
+    def wait(self):
+        """run the setup steps left, blocking"""
+        while not self.FLAG_READY:
+            data = self.socket.recv(CLIENT_RECV_SIZE)
+            if not data:
+                name = self.pending[0] if self.pending is not None else 'handshake'
+                raise ConnectionError(f"server closed the connection waiting for ({name})")
+            res = self.feed(data)
+            if res:
+                self.socket.sendall(res)
+        return
+
+    def connect(self):
+        """handshake, connect and createStream"""
+        self.socket.settimeout(self.timeout)
+        self.socket.sendall(self.begin())
+        self.wait()
+        return
+
+    def publish(self, stream_name: str):
+        self.steps.append(self.action(stream_name, True))
+        self.FLAG_READY = False
+        self.socket.sendall(self.next_command())
+        self.wait()
+        self.socket.settimeout(None)
+        return
+
+    def play(self, stream_name: str):
+        self.steps.append(self.action(stream_name, False))
+        self.FLAG_READY = False
+        self.socket.sendall(self.next_command())
+        self.wait()
+        self.socket.settimeout(None)
+        return
@@ -8,6 +8,9 @@ RTMP_CONTROL_TYPES = [TYPE_CONTROL_SET_CHUNK, TYPE_CONTROL_ABORT_MESSAGE,
                       TYPE_CONTROL_ACK, TYPE_CONTROL_ACK_SIZE, TYPE_CONTROL_SET_BANDWIDTH]
 RTMP_CONTROL_CID = 2
 RTMP_CONTROL_MID = 0
+RTMP_DEFAULT_CHUNK_SIZE = 128
+RTMP_MAX_CHUNK_SIZE = 0x7FFFFFFF
+RTMP_MAX_MESSAGE_LENGTH = 0xFFFFFF  # 3 bytes message length field
 
 # streaming control message
 TYPE_USER_CONTROL_MESSAGE = 4
@@ -38,6 +41,27 @@ TYPE_AGGREGATE = 22
 
 # rtmp command messages
 COMMANDS_NetConnection = ['connect', 'call', 'close', 'createStream']
+COMMANDS_NetStream = ['play', 'play2', 'deleteStream', 'closeStream', 'receiveAudio', 'receiveVideo',
+                      'publish', 'seek', 'pause']
+COMMAND_RESULT = '_result'
+COMMAND_ERROR = '_error'
+COMMAND_STATUS = 'onStatus'
+
+# chunk stream ids and message stream id used for messages we send
+RTMP_COMMAND_CID = 3
+RTMP_AUDIO_CID = 4
+RTMP_DATA_CID = 5
+RTMP_VIDEO_CID = 6
+RTMP_STREAM_MID = 1
+
+# set peer bandwidth limit types
+BANDWIDTH_LIMIT_HARD = 0
+BANDWIDTH_LIMIT_SOFT = 1
+BANDWIDTH_LIMIT_DYNAMIC = 2
+
+# rtmp data messages
+DATA_SET_DATA_FRAME = '@setDataFrame'
+DATA_ON_METADATA = 'onMetaData'
 
 # rtmp audio flag
 SUPPORT_SND_NONE = 0x0001
@@ -48,4 +72,13 @@ SUPPORT_SND_ALL = 0x0FFF
 # rtmp video flag
 SUPPORT_VID_H264 = 0x0080
 SUPPORT_VID_ALL = 0x00FF
-SUPPORT_VID_CLIENT_SEEK = 0x01
\ No newline at end of file
+SUPPORT_VID_CLIENT_SEEK = 0x01
+
+# flv audio/video tag headers
+FLV_CODEC_AVC = 7
+FLV_CODEC_AAC = 10
+FLV_FRAME_KEY = 1
+FLV_AVC_SEQUENCE_HEADER = 0
+FLV_AVC_NALU = 1
+FLV_AAC_SEQUENCE_HEADER = 0
+FLV_AAC_RAW = 1
\ No newline at end of file
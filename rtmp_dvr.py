@@ -0,0 +1,133 @@
+"""
+in-memory time-shift (dvr) buffer of a live stream.
+- frame bytes are appended to large preallocated arenas, frames are only (arena, offset, size) entries in arrays
+- a keyframe index lets players start from any point of the window
+- the oldest frames are evicted first, when older than the window or when the buffer is full.
+    memory in use is about bitrate x window, plus one arena
+"""
+from array import array
+from bisect import bisect_right
+
+DVR_WINDOW = 300  # seconds
+DVR_MAX_SIZE = 256 * 1024 * 1024  # bytes of frames per stream, whatever the window
+DVR_ARENA_SIZE = 4 * 1024 * 1024
+DVR_COMPACT = 4096  # evicted entries are removed from the front of the index arrays by batches of this
+
+
+class DVRBuffer:
+    """
+    frames are numbered from 0 in arrival order, numbers stay valid while the frame is in the buffer.
+    frame `n` is in the index arrays at `n - base`, frames from `base` to `first` are evicted but not compacted yet
+    """
+    __slots__ = ('window', 'max_size', 'arena_size', 'arenas', 'spare', 'arena_no', 'arena_pos',
+                 'types', 'timestamps', 'arena_nos', 'offsets', 'sizes', 'keyframes', 'key_start',
+                 'base', 'first', 'end', 'size')
+
+    def __init__(self, window: float = DVR_WINDOW, max_size: int = DVR_MAX_SIZE, arena_size: int = DVR_ARENA_SIZE):
+        self.window = int(window * 1000)  # ms, as rtmp timestamps
+        self.max_size = max_size
+        self.arena_size = arena_size
+
+        self.arenas = dict()  # arena number -> bytearray
+        self.spare = None  # emptied arena, reused for the next one
+        self.arena_no = 0
+        self.arena_pos = 0
+        self.arenas[0] = bytearray(arena_size)
+
+        self.types = array('B')
+        self.timestamps = array('q')
+        self.arena_nos = array('I')
+        self.offsets = array('I')
+        self.sizes = array('I')
+        self.keyframes = array('q')  # frame numbers, keyframes before `key_start` are evicted
+        self.key_start = 0
+
+        self.base = 0
+        self.first = 0
+        self.end = 0
+        self.size = 0  # bytes of the frames in the buffer
+
+    def append(self, mtype: int, timestamp: int, data: bytes, key: bool = False):
+        size = len(data)
+        self.evict(timestamp - self.window, size)
+
+        arena = self.arenas[self.arena_no]
+        if self.arena_pos + size > len(arena):
+            arena = self.spare if self.spare is not None and len(self.spare) >= size else None
+            self.spare = None
+            if arena is None:
+                arena = bytearray(max(self.arena_size, size))
+            self.arena_no += 1
+            self.arenas[self.arena_no] = arena
+            self.arena_pos = 0
+
+        pos = self.arena_pos
+        arena[pos:pos + size] = data
+        self.arena_pos = pos + size
+
+        self.types.append(mtype)
+        self.timestamps.append(timestamp)
+        self.arena_nos.append(self.arena_no)
+        self.offsets.append(pos)
+        self.sizes.append(size)
+        if key:
+            self.keyframes.append(self.end)
+        self.end += 1
+        self.size += size
+        return
+
+    def evict(self, oldest: int, incoming: int = 0):
+        """drop frames older than `oldest` (ms), and as many as needed for `incoming` more bytes"""
+        base = self.base
+        while self.first < self.end and (self.timestamps[self.first - base] < oldest or
+                                         self.size + incoming > self.max_size):
+            index = self.first - base
+            self.size -= self.sizes[index]
+            no = self.arena_nos[index]
+            self.first += 1
+            # the arena is free once its last frame is gone, keep it for the next one
+            if no != self.arena_no and (self.first == self.end or self.arena_nos[index + 1] != no):
+                self.spare = self.arenas.pop(no)
+
+        keyframes = self.keyframes
+        while self.key_start < len(keyframes) and keyframes[self.key_start] < self.first:
+            self.key_start += 1
+
+        if self.first - base >= DVR_COMPACT:
+            count = self.first - base
+            for a in (self.types, self.timestamps, self.arena_nos, self.offsets, self.sizes):
+                del a[:count]
+            self.base = self.first
+            del keyframes[:self.key_start]
+            self.key_start = 0
+        return
+
+    def get(self, number: int):
+        """(message type, timestamp, data) of frame `number`, data is a view on the arena"""
+        index = number - self.base
+        offset = self.offsets[index]
+        return self.types[index], self.timestamps[index], \
+            memoryview(self.arenas[self.arena_nos[index]])[offset:offset + self.sizes[index]]
+
+    def seek(self, timestamp: int):
+        """number of the last keyframe at or before `timestamp`, the oldest keyframe if none. None when empty"""
+        if self.key_start == len(self.keyframes):
+            return None
+        base = self.base
+        timestamps = self.timestamps
+        i = bisect_right(self.keyframes, timestamp, lo=self.key_start, key=lambda n: timestamps[n - base])
+        return self.keyframes[max(i - 1, self.key_start)]
+
+    @property
+    def oldest(self):
+        """timestamp of the oldest frame"""
+        return self.timestamps[self.first - self.base] if self.end > self.first else 0
+
+    @property
+    def live(self):
+        """timestamp of the newest frame"""
+        return self.timestamps[self.end - 1 - self.base] if self.end > self.first else 0
+
+    @property
+    def allocated(self):
+        return sum(len(_) for _ in self.arenas.values()) + (len(self.spare) if self.spare is not None else 0)
@@ -8,3 +8,7 @@ class RTMP_NotHeader(BaseException):
 
 class RTMP_MultiplePacketsInBuffer(BaseException):
     pass
+
+
+class RTMP_ProtocolError(BaseException):
+    pass
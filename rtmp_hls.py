@@ -0,0 +1,401 @@
+"""
+hls output of published streams: h264/aac from flv tagged rtmp messages remuxed into mpeg-ts segments,
+with a rolling m3u8 playlist in the stream's directory. nothing is decoded or transcoded.
+- the network loop only queues messages (`HLSSegmenter.feed`), remuxing and file io run in a worker thread
+- ts packets are built in one preallocated 188 bytes buffer, yielded to the writer packet by packet
+- segments start on video keyframes (on any audio frame for audio only streams)
+"""
+from rtmp_constants import *
+from rtmp_logging import ConnectionLogger
+import logging
+import math
+import os
+import queue
+import struct
+import threading
+
+HLS_PLAYLIST = 'index.m3u8'
+HLS_SEGMENT_DURATION = 4  # seconds, segments are cut on the first keyframe after this
+HLS_PLAYLIST_SIZE = 6  # segments listed in the playlist
+HLS_KEEP_SEGMENTS = 2  # segments kept on disk after leaving the playlist, players may still be downloading them
+HLS_QUEUE_SIZE = 1024  # messages waiting for the worker, more are dropped until the next keyframe
+HLS_STOP_POLL = 1  # seconds the worker waits for a message before checking whether it was stopped
+
+TS_PACKET_SIZE = 188
+TS_PAT_PID = 0x0000
+TS_PMT_PID = 0x1000
+TS_VIDEO_PID = 0x0100
+TS_AUDIO_PID = 0x0101
+TS_STREAM_TYPE_H264 = 0x1b
+TS_STREAM_TYPE_AAC = 0x0f
+TS_STREAM_ID_VIDEO = 0xe0
+TS_STREAM_ID_AUDIO = 0xc0
+TS_CLOCK = 90  # 90kHz clock ticks per rtmp millisecond
+TS_DELAY = 63000  # pts/dts are ahead of pcr by 0.7s, decoders need the data before presenting it
+
+NAL_START = b'\x00\x00\x00\x01'
+NAL_AUD = NAL_START + b'\x09\xf0'  # access unit delimiter, any slice type
+NAL_TYPE_SPS = 7
+NAL_TYPE_AUD = 9
+
+
+def _crc32_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x04c11db7 if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xffffffff)
+    return table
+
+
+CRC32_TABLE = _crc32_table()
+
+
+def crc32_mpeg2(data: bytes):
+    crc = 0xffffffff
+    for b in data:
+        crc = ((crc << 8) & 0xffffffff) ^ CRC32_TABLE[(crc >> 24) ^ b]
+    return crc
+
+
+def pes_timestamp(flag: int, ts: int):
+    """33 bits pts/dts, split by marker bits"""
+    return bytes((
+        flag << 4 | (ts >> 29) & 0x0e | 1,
+        (ts >> 22) & 0xff,
+        (ts >> 14) & 0xfe | 1,
+        (ts >> 7) & 0xff,
+        (ts << 1) & 0xfe | 1,
+    ))
+
+
+class TSMuxer:
+    """mpeg-ts packetizer of a single program, with a video and/or an audio elementary stream"""
+    __slots__ = ('packet', 'view', 'continuity', 'video', 'audio')
+
+    def __init__(self):
+        self.packet = bytearray(TS_PACKET_SIZE)
+        self.view = memoryview(self.packet)
+        self.continuity = dict()
+        self.video = False
+        self.audio = False
+
+    def header(self, pid: int, start: bool, adaptation: bool):
+        cc = self.continuity.get(pid, 0)
+        self.continuity[pid] = (cc + 1) & 0x0f
+
+        packet = self.packet
+        packet[0] = 0x47
+        packet[1] = (0x40 if start else 0x00) | pid >> 8
+        packet[2] = pid & 0xff
+        packet[3] = (0x30 if adaptation else 0x10) | cc
+        return
+
+    def psi(self, pid: int, table_id: int, body: bytes):
+        """single packet table section (pat/pmt)"""
+        # section_syntax_indicator, section_length (+ 5 bytes of header and 4 of crc)
+        section = struct.pack('>BH', table_id, 0xb000 | len(body) + 9) + \
+            struct.pack('>HBBB', 1, 0xc1, 0, 0) + body  # id 1, version 0, current, section 0 of 0
+        section += struct.pack('>I', crc32_mpeg2(section))
+
+        self.header(pid, True, False)
+        packet = self.packet
+        packet[4] = 0  # pointer field
+        packet[5:5 + len(section)] = section
+        packet[5 + len(section):] = b'\xff' * (TS_PACKET_SIZE - 5 - len(section))
+        return self.view
+
+    def tables(self):
+        """pat and pmt, written at the start of every segment"""
+        yield self.psi(TS_PAT_PID, 0x00, struct.pack('>HH', 1, 0xe000 | TS_PMT_PID))
+
+        pcr_pid = TS_VIDEO_PID if self.video else TS_AUDIO_PID
+        body = struct.pack('>HH', 0xe000 | pcr_pid, 0xf000)  # no program info
+        if self.video:
+            body += struct.pack('>BHH', TS_STREAM_TYPE_H264, 0xe000 | TS_VIDEO_PID, 0xf000)
+        if self.audio:
+            body += struct.pack('>BHH', TS_STREAM_TYPE_AAC, 0xe000 | TS_AUDIO_PID, 0xf000)
+        yield self.psi(TS_PMT_PID, 0x02, body)
+
+    def pes(self, pid: int, stream_id: int, payload: bytes, pts: int, dts: int, pcr: int = None, key: bool = False):
+        """
+        packetize one access unit, yields the same packet buffer filled for every ts packet.
+        :param pcr: program clock (90kHz), carried in the first packet of the pes
+        """
+        if pts == dts:
+            header = pes_timestamp(0x2, pts)
+        else:
+            header = pes_timestamp(0x3, pts) + pes_timestamp(0x1, dts)
+        # pes packet length only fits audio frames, 0 (unbounded) is allowed for video
+        length = len(header) + 3 + len(payload)
+        header = struct.pack('>3sBHBBB', b'\x00\x00\x01', stream_id, length if length <= 0xffff else 0,
+                             0x80, 0x80 if pts == dts else 0xc0, len(header)) + header
+
+        packet = self.packet
+        view = self.view
+        offset = 0
+        first = True
+        while offset < len(payload) or first:
+            adaptation = first and (pcr is not None or key)
+            self.header(pid, first, adaptation)
+            pos = 4
+            if adaptation:
+                packet[5] = 0x40 if key else 0x00  # random access indicator
+                pos = 6
+                if pcr is not None:
+                    packet[5] |= 0x10
+                    packet[6:12] = struct.pack('>IH', pcr >> 1 & 0xffffffff, (pcr & 1) << 15 | 0x7e00)
+                    pos = 12
+                packet[4] = pos - 5
+
+            head = header if first else b''
+            room = TS_PACKET_SIZE - pos - len(head)
+            size = min(room, len(payload) - offset)
+            if size < room:
+                # fill the gap with adaptation field stuffing
+                stuffing = room - size
+                if adaptation:
+                    packet[4] += stuffing
+                    packet[pos:pos + stuffing] = b'\xff' * stuffing
+                else:
+                    packet[3] |= 0x20
+                    packet[4] = stuffing - 1
+                    if stuffing > 1:
+                        packet[5] = 0x00
+                        packet[6:4 + stuffing] = b'\xff' * (stuffing - 2)
+                pos += stuffing
+
+            packet[pos:pos + len(head)] = head
+            pos += len(head)
+            packet[pos:] = payload[offset:offset + size]
+            offset += size
+            first = False
+            yield view
+
+
+class HLSSegmenter:
+    """
+    remuxes the audio/video messages of a published stream into `stream_path`.
+    `feed` and `close` are called from the network loop, everything else runs in the worker thread.
+    """
+    def __init__(self, stream_path: str, log: ConnectionLogger, segment_duration: float = HLS_SEGMENT_DURATION,
+                 playlist_size: int = HLS_PLAYLIST_SIZE):
+        self.path = stream_path
+        self.log = log
+        self.segment_duration = segment_duration * 1000  # ms, as rtmp timestamps
+        self.playlist_size = playlist_size
+
+        self.queue = queue.Queue(HLS_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, name=f"hls {stream_path}", daemon=True)
+        self.stopped = threading.Event()  # set by `close` when the queue is too full to take the end marker
+        self.FLAG_DROPPING = False
+
+        # worker state
+        self.muxer = TSMuxer()
+        self.avc_header = None  # sps/pps in annex b, in front of every keyframe
+        self.nal_length_size = 4
+        self.aac_header = None  # adts header prefix from the audio specific config
+        self.file = None
+        self.sequence = 0
+        self.segment_start = 0
+        self.last_timestamp = 0
+        self.segments = []  # (sequence, duration in seconds) of the finished segments
+        # must not change during the stream. only raised when a segment ran longer (keyframes further apart)
+        self.target_duration = math.ceil(segment_duration)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def feed(self, mtype: int, timestamp: int, data: bytes):
+        """
+        queue an audio/video message. message bodies own their buffer, nothing is copied.
+        when the worker can't keep up, everything is dropped until the next keyframe so segments stay decodable
+        """
+        if self.FLAG_DROPPING:
+            if not (mtype == TYPE_VIDEO and len(data) > 1 and data[0] >> 4 == FLV_FRAME_KEY):
+                return
+            self.FLAG_DROPPING = False
+        try:
+            self.queue.put_nowait((mtype, timestamp, data))
+        except queue.Full:
+            self.log.sampled('hls-drop', logging.WARNING, "hls worker is late, dropping until the next keyframe")
+            self.FLAG_DROPPING = True
+
+    def close(self):
+        """finish the last segment and end the playlist, does not wait for the worker"""
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            # the worker is late, what is still queued is dropped
+            self.stopped.set()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                try:
+                    item = self.queue.get(timeout=HLS_STOP_POLL)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                self.write(*item)
+            self.close_segment(self.last_timestamp, end=True)
+        except Exception as e:  # noqa: a broken segmenter must not take the stream down
+            self.log.exception("hls segmenter failed: %s", e)
+            if self.file is not None:
+                self.file.close()
+        return
+
+    def write(self, mtype: int, timestamp: int, data: bytes):
+        if len(data) < 2:
+            return
+        if mtype == TYPE_VIDEO:
+            if data[0] & 0x0f != FLV_CODEC_AVC:
+                self.log.sampled('hls-codec', logging.WARNING, "hls: unsupported video codec (%d)", data[0] & 0x0f)
+                return
+            if data[1] == FLV_AVC_SEQUENCE_HEADER:
+                self.parse_avc_config(data[5:])
+            elif data[1] == FLV_AVC_NALU and self.avc_header is not None:
+                self.write_video(timestamp, data[0] >> 4 == FLV_FRAME_KEY, data)
+        elif mtype == TYPE_AUDIO:
+            if data[0] >> 4 != FLV_CODEC_AAC:
+                self.log.sampled('hls-codec', logging.WARNING, "hls: unsupported audio codec (%d)", data[0] >> 4)
+                return
+            if data[1] == FLV_AAC_SEQUENCE_HEADER:
+                self.parse_aac_config(data[2:])
+            elif data[1] == FLV_AAC_RAW and self.aac_header is not None:
+                self.write_audio(timestamp, data[2:])
+        return
+
+    def parse_avc_config(self, config: bytes):
+        # AVCDecoderConfigurationRecord
+        self.nal_length_size = (config[4] & 0x03) + 1
+        nals = []
+        pos = 5
+        for count_mask in (0x1f, 0xff):  # sps, then pps
+            count = config[pos] & count_mask
+            pos += 1
+            for _ in range(count):
+                size = int.from_bytes(config[pos:pos + 2], 'big')
+                nals.append(NAL_START + bytes(config[pos + 2:pos + 2 + size]))
+                pos += 2 + size
+        self.avc_header = b''.join(nals)
+        self.muxer.video = True
+        return
+
+    def parse_aac_config(self, config: bytes):
+        # AudioSpecificConfig: object type (5 bits), sampling frequency index (4), channel configuration (4)
+        profile = (config[0] >> 3) - 1
+        frequency = (config[0] & 0x07) << 1 | config[1] >> 7
+        channels = (config[1] >> 3) & 0x0f
+        # adts fixed header, mpeg-4, no crc. the frame length is filled per frame
+        self.aac_header = (0xfff1, (profile & 0x03) << 6 | frequency << 2 | channels >> 2, (channels & 0x03) << 6)
+        self.muxer.audio = True
+        return
+
+    def write_video(self, timestamp: int, key: bool, data: bytes):
+        if key and (self.file is None or timestamp - self.segment_start >= self.segment_duration):
+            self.open_segment(timestamp)
+        if self.file is None:  # waiting for the first keyframe
+            return
+
+        cts = int.from_bytes(data[2:5], 'big', signed=True)
+        # length prefixed nal units to annex b, every access unit starting with a delimiter
+        nals = [NAL_AUD, b'']
+        in_band = False  # the encoder repeats sps/pps on keyframes itself
+        pos = 5
+        size_len = self.nal_length_size
+        while pos + size_len <= len(data):
+            size = int.from_bytes(data[pos:pos + size_len], 'big')
+            pos += size_len
+            nal_type = data[pos] & 0x1f if pos < len(data) else 0
+            if nal_type != NAL_TYPE_AUD:
+                in_band |= nal_type == NAL_TYPE_SPS
+                nals.append(NAL_START)
+                nals.append(data[pos:pos + size])
+            pos += size
+        if key and not in_band:
+            nals[1] = self.avc_header
+
+        dts = timestamp * TS_CLOCK
+        write = self.file.write
+        for packet in self.muxer.pes(TS_VIDEO_PID, TS_STREAM_ID_VIDEO, b''.join(nals),
+                                     dts + cts * TS_CLOCK + TS_DELAY, dts + TS_DELAY, pcr=dts, key=key):
+            write(packet)
+        self.last_timestamp = timestamp
+        return
+
+    def write_audio(self, timestamp: int, frame: bytes):
+        if not self.muxer.video and (self.file is None or timestamp - self.segment_start >= self.segment_duration):
+            self.open_segment(timestamp)
+        if self.file is None:
+            return
+
+        length = len(frame) + 7
+        sync, b2, b3 = self.aac_header
+        adts = struct.pack('>HBBBBB', sync, b2, b3 | length >> 11, (length >> 3) & 0xff, (length & 0x07) << 5 | 0x1f,
+                           0xfc)
+        pts = timestamp * TS_CLOCK + TS_DELAY
+        write = self.file.write
+        # audio only streams carry the pcr on the audio pid
+        pcr = None if self.muxer.video else timestamp * TS_CLOCK
+        for packet in self.muxer.pes(TS_AUDIO_PID, TS_STREAM_ID_AUDIO, adts + frame, pts, pts, pcr=pcr):
+            write(packet)
+        self.last_timestamp = max(self.last_timestamp, timestamp)
+        return
+
+    def open_segment(self, timestamp: int):
+        if self.file is not None:
+            self.close_segment(timestamp)
+        self.file = open(os.path.join(self.path, f"{self.sequence}.ts"), 'wb')
+        self.segment_start = timestamp
+        for packet in self.muxer.tables():
+            self.file.write(packet)
+        return
+
+    def close_segment(self, timestamp: int, end: bool = False):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            duration = (timestamp - self.segment_start) / 1000
+            self.segments.append((self.sequence, duration))
+            self.sequence += 1
+            # rfc 8216: every duration rounded to the nearest integer fits the target duration
+            self.target_duration = max(self.target_duration, math.floor(duration + 0.5))
+
+        # drop what left the playlist, files a few segments later
+        while len(self.segments) > self.playlist_size:
+            self.segments.pop(0)
+        expired = self.sequence - self.playlist_size - HLS_KEEP_SEGMENTS - 1
+        if expired >= 0:
+            try:
+                os.remove(os.path.join(self.path, f"{expired}.ts"))
+            except FileNotFoundError:
+                pass
+
+        self.write_playlist(end)
+        return
+
+    def write_playlist(self, end: bool = False):
+        if not self.segments:
+            return
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            f"#EXT-X-MEDIA-SEQUENCE:{self.segments[0][0]}",
+        ]
+        for sequence, duration in self.segments:
+            lines.append(f"#EXTINF:{duration:.3f},")
+            lines.append(f"{sequence}.ts")
+        if end:
+            lines.append('#EXT-X-ENDLIST')
+
+        # players must never read a half written playlist
+        path = os.path.join(self.path, HLS_PLAYLIST)
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+        return
@@ -0,0 +1,84 @@
+import logging
+import logging.handlers
+import queue
+import time
+
+LOGGER_NAME = 'rtmp'
+LOG_FORMAT = '[%(asctime)s] %(levelname)s %(name)s: %(message)s'
+
+# hot path events (per packet/chunk) are emitted at most once per interval, per connection and key
+SAMPLE_INTERVAL = 1.0
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+def setup_logging(level: int = logging.INFO, handler: logging.Handler = None):
+    """
+    route every `rtmp` log record through a queue, so the network loop never blocks on stdout/file io.
+    - records are written by a background `QueueListener` thread into `handler` (default: stderr)
+    - returns the listener, call `listener.stop()` to flush the queue on shutdown
+    """
+    if handler is None:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    for h in logger.handlers[:]:
+        logger.removeHandler(h)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class ConnectionLogger(logging.LoggerAdapter):
+    """
+    logger with per-connection context.
+    - context (`peer`, `stream_id`..) is cached once, usually at accept time,
+        and attached to every record as attributes for structured handlers
+    - use `sampled` for events happening per packet/chunk
+    """
+
+    def __init__(self, extra: dict, base: logging.Logger = logger):
+        super().__init__(base, extra)
+        self.prefix = self.make_prefix()
+        self.samples = {}
+
+    def make_prefix(self):
+        return ' '.join(f"{key}={value}" for key, value in self.extra.items() if value is not None)
+
+    def bind(self, **kwargs):
+        """add context to this connection, e.g. stream id once the stream object is made"""
+        self.extra.update(kwargs)
+        self.prefix = self.make_prefix()
+        return self
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = self.extra
+        return f"({self.prefix}) {msg}", kwargs
+
+    def sampled(self, key: str, level: int, msg: str, *args):
+        """
+        rate limited log for the hot path. the format arguments are only evaluated when emitted,
+        and the number of suppressed events is appended to the next emitted one.
+        """
+        if not self.isEnabledFor(level):
+            return
+
+        now = time.monotonic()
+        sample = self.samples.get(key)
+        if sample is None:
+            sample = self.samples[key] = [0.0, 0]
+        if now < sample[0]:
+            sample[1] += 1
+            return
+
+        if sample[1]:
+            msg += f" ({sample[1]} suppressed)"
+        sample[0] = now + SAMPLE_INTERVAL
+        sample[1] = 0
+        self.log(level, msg, *args)
+        return
@@ -0,0 +1,227 @@
+from array import array
+from bisect import bisect_left
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socketserver
+import socket
+import struct
+import threading
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # windows
+    fcntl = None
+    termios = None
+
+# counter indexes of `StreamMetrics.counters`
+BYTES_IN = 0
+BYTES_OUT = 1
+MESSAGES_IN = 2
+ACK_SEQUENCE = 3
+ACK_LAG = 4
+COUNTER_SIZE = 5
+
+# histogram buckets
+CHUNK_SIZE_BUCKETS = (128, 256, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+PARSE_TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+
+# offset of `tcpi_rtt` (u32, microseconds) in linux `struct tcp_info`
+TCP_INFO_RTT_OFFSET = 68
+
+
+class Histogram:
+    """
+    fixed bucket histogram on a preallocated array.
+    - `counts[i]` counts values <= `bounds[i]`, the last slot counts everything above
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = array('Q', bytes(8 * (len(bounds) + 1)))
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        return
+
+    def render(self, name: str, labels: str):
+        res = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            res.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        total += self.counts[-1]
+        res.append(f'{name}_bucket{{{labels},le="+Inf"}} {total}')
+        res.append(f'{name}_sum{{{labels}}} {self.sum}')
+        res.append(f'{name}_count{{{labels}}} {total}')
+        return res
+
+
+class StreamMetrics:
+    """
+    counters and histograms of a single stream (connection).
+    everything is preallocated when the stream is made, updating never allocates.
+    """
+    __slots__ = ('counters', 'messages', 'chunk_size', 'parse_time')
+
+    def __init__(self):
+        self.counters = array('Q', bytes(8 * COUNTER_SIZE))
+        self.messages = array('Q', bytes(8 * 256))  # by message type id
+        self.chunk_size = Histogram(CHUNK_SIZE_BUCKETS)
+        self.parse_time = Histogram(PARSE_TIME_BUCKETS)
+
+    def received(self, size: int):
+        self.counters[BYTES_IN] += size
+        return
+
+    def sent(self, size: int):
+        self.counters[BYTES_OUT] += size
+        return
+
+    def message(self, mtype: int):
+        self.counters[MESSAGES_IN] += 1
+        self.messages[mtype or 0] += 1
+        return
+
+    def chunk(self, size: int):
+        """payload size of one received chunk, without its header"""
+        self.chunk_size.observe(size)
+        return
+
+    def parsed(self, elapsed: float):
+        self.parse_time.observe(elapsed)
+        return
+
+    def ack(self, sequence: int):
+        """peer acknowledged `sequence` bytes, lag is what we sent and is not acknowledged yet"""
+        self.counters[ACK_SEQUENCE] = sequence
+        self.counters[ACK_LAG] = (self.counters[BYTES_OUT] - sequence) & 0xFFFFFFFF
+        return
+
+
+def socket_outbound_queue(sock: socket.socket):
+    """bytes written to the socket but not sent yet, or None if unavailable"""
+    if fcntl is None or not hasattr(termios, 'TIOCOUTQ'):
+        return None
+    try:
+        buf = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\x00' * 4)
+    except (OSError, ValueError):
+        return None
+    return struct.unpack('i', buf)[0]
+
+
+def socket_rtt(sock: socket.socket):
+    """smoothed tcp rtt in seconds, or None if unavailable"""
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        buf = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except (OSError, ValueError):
+        return None
+    if len(buf) < TCP_INFO_RTT_OFFSET + 4:
+        return None
+    return struct.unpack_from('I', buf, TCP_INFO_RTT_OFFSET)[0] / 1000000
+
+
+def label_value(value: str):
+    # stream names come from the peer
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(streams: list):
+    """render metrics of `streams` (list of StreamObject) in prometheus text format"""
+    families = {
+        'rtmp_bytes_in_total': ('counter', 'bytes received from the peer', []),
+        'rtmp_bytes_out_total': ('counter', 'bytes sent to the peer', []),
+        'rtmp_messages_total': ('counter', 'messages received, by message type id', []),
+        'rtmp_chunk_size_bytes': ('histogram', 'size of received chunk payloads', []),
+        'rtmp_parse_seconds': ('histogram', 'time spent parsing one received buffer', []),
+        'rtmp_outbound_queue_bytes': ('gauge', 'bytes queued in the socket send buffer', []),
+        'rtmp_send_pending_bytes': ('gauge', 'bytes the socket did not take yet, queued by the server', []),
+        'rtmp_ack_lag_bytes': ('gauge', 'bytes sent and not acknowledged by the peer yet', []),
+        'rtmp_rtt_seconds': ('gauge', 'smoothed tcp round trip time', []),
+    }
+
+    for stream in streams:
+        metrics = stream.metrics
+        # the key is known once the peer publishes or plays, until then the label is empty
+        labels = f'stream_id="{stream.stream_id}",peer="{stream.peer}",' \
+                 f'stream_key="{label_value(stream.stream_key or "")}"'
+        families['rtmp_bytes_in_total'][2].append(f'rtmp_bytes_in_total{{{labels}}} {metrics.counters[BYTES_IN]}')
+        families['rtmp_bytes_out_total'][2].append(f'rtmp_bytes_out_total{{{labels}}} {metrics.counters[BYTES_OUT]}')
+        for mtype, count in enumerate(metrics.messages):
+            if count:
+                families['rtmp_messages_total'][2].append(f'rtmp_messages_total{{{labels},type="{mtype}"}} {count}')
+        families['rtmp_chunk_size_bytes'][2].extend(metrics.chunk_size.render('rtmp_chunk_size_bytes', labels))
+        families['rtmp_parse_seconds'][2].extend(metrics.parse_time.render('rtmp_parse_seconds', labels))
+        families['rtmp_ack_lag_bytes'][2].append(f'rtmp_ack_lag_bytes{{{labels}}} {metrics.counters[ACK_LAG]}')
+        # a slow player backs up here first, it is dropped past MAX_SEND_PENDING
+        families['rtmp_send_pending_bytes'][2].append(
+            f'rtmp_send_pending_bytes{{{labels}}} {len(stream.send_pending)}')
+
+        queued = socket_outbound_queue(stream.sock)
+        if queued is not None:
+            families['rtmp_outbound_queue_bytes'][2].append(f'rtmp_outbound_queue_bytes{{{labels}}} {queued}')
+        rtt = socket_rtt(stream.sock)
+        if rtt is not None:
+            families['rtmp_rtt_seconds'][2].append(f'rtmp_rtt_seconds{{{labels}}} {rtt}')
+
+    res = []
+    for name, (kind, doc, lines) in families.items():
+        res.append(f'# HELP {name} {doc}')
+        res.append(f'# TYPE {name} {kind}')
+        res.extend(lines)
+    return '\n'.join(res) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            body = self.server.collect()
+        elif url.path in self.server.routes:
+            try:
+                body = self.server.routes[url.path](parse_qs(url.query))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_metrics_server(addr, collect, routes: dict = None):
+    """
+    serve `collect()` as `GET /metrics` in a background thread.
+    :param addr: (host, port) for http over tcp, or a path (str) for http over unix socket
+    :param collect: function returning prometheus text
+    :param routes: optional admin commands, {path: function(query: dict) returning text}.
+        a command raising ValueError is answered with 400
+    """
+    if isinstance(addr, str):
+        server = UnixHTTPServer(addr, MetricsHandler)
+    else:
+        server = ThreadingHTTPServer(addr, MetricsHandler)
+    server.collect = collect
+    server.routes = routes or dict()
+
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
@@ -0,0 +1,132 @@
+from collections import Counter
+from rtmp_metrics import Histogram
+from rtmp_logging import logger
+import signal
+import sys
+import threading
+import time
+import traceback
+
+# callback latency buckets, in seconds
+CALLBACK_TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+STALL_THRESHOLD = 0.05
+SAMPLE_INTERVAL = 0.001
+PROFILE_SECONDS = 10
+PROFILE_MAX_SECONDS = 300  # longest sampling accepted from the admin route
+
+
+class LoopProfiler:
+    """
+    opt-in instrumentation of the selector loop.
+    - `call` times every callback and keeps a latency histogram per callback name
+    - a watchdog thread logs callbacks running longer than `threshold`, with the stack of the loop thread
+    - `start_sampling` samples the loop thread stack for some seconds, then logs and dumps the result
+        in collapsed stack format (one `frame;frame;frame count` per line, readable by flamegraph tools)
+    """
+
+    def __init__(self, threshold: float = STALL_THRESHOLD, dump_path: str = None):
+        self.threshold = threshold
+        self.dump_path = dump_path
+        self.histograms = dict()
+
+        self.loop_thread = threading.get_ident()
+        self.current = None  # (callback name, start time, call id) of running callback
+        self.call_id = 0
+
+        self.watchdog = None
+        self.watchdog_event = threading.Event()
+        self.sampler = None
+        self.sampler_lock = threading.Lock()
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.watchdog_event.set()
+        self.watchdog = threading.Thread(target=self.watch, daemon=True)
+        self.watchdog.start()
+
+        # `kill -USR1 <pid>` starts the sampling profiler
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.start_sampling())
+        return
+
+    def stop(self):
+        self.watchdog_event.clear()
+        if self.watchdog is not None:
+            self.watchdog.join()
+        return
+
+    def call(self, callback, *args):
+        name = getattr(callback, '__qualname__', repr(callback))
+        self.call_id += 1
+        start = time.perf_counter()
+        self.current = (name, start, self.call_id)
+        try:
+            return callback(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.current = None
+
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(CALLBACK_TIME_BUCKETS)
+            histogram.observe(elapsed)
+            if elapsed > self.threshold:
+                logger.warning("callback (%s) took (%.1f) ms", name, elapsed * 1000)
+
+    def watch(self):
+        reported = 0
+        while self.watchdog_event.is_set():
+            time.sleep(self.threshold / 2)
+            current = self.current
+            if current is None or current[2] == reported:
+                continue
+
+            name, start, call_id = current
+            if time.perf_counter() - start > self.threshold:
+                reported = call_id
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+                logger.warning("event loop stalled in (%s) for more than (%.1f) ms:\n%s",
+                               name, self.threshold * 1000, stack)
+        return
+
+    def start_sampling(self, seconds: float = PROFILE_SECONDS):
+        """sample the loop thread for `seconds`, does nothing if a sampling is already running"""
+        with self.sampler_lock:
+            if self.sampler is not None and self.sampler.is_alive():
+                return False
+            self.sampler = threading.Thread(target=self.sample, args=(seconds,), daemon=True)
+            self.sampler.start()
+        return True
+
+    def sample(self, seconds: float):
+        logger.info("sampling event loop for (%s) seconds", seconds)
+        stacks = Counter()
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                stacks[';'.join(f"{f.f_code.co_name} ({f.f_code.co_filename}:{f.f_lineno})"
+                                for f, _ in reversed(list(traceback.walk_stack(frame))))] += 1
+            time.sleep(SAMPLE_INTERVAL)
+
+        total = sum(stacks.values()) or 1
+        top = '\n'.join(f"{count * 100 / total:5.1f}% {stack.rsplit(';', 1)[-1]}"
+                        for stack, count in stacks.most_common(10))
+        logger.info("sampled (%d) stacks, top:\n%s", total, top)
+
+        if self.dump_path is not None:
+            with open(self.dump_path, 'w') as f:
+                for stack, count in stacks.items():
+                    f.write(f"{stack} {count}\n")
+            logger.info("sampled stacks written to (%s)", self.dump_path)
+        return stacks
+
+    def render(self):
+        """callback latency histograms in prometheus text format"""
+        res = ['# HELP rtmp_callback_seconds time spent in selector loop callbacks',
+               '# TYPE rtmp_callback_seconds histogram']
+        for name, histogram in list(self.histograms.items()):
+            res.extend(histogram.render('rtmp_callback_seconds', f'callback="{name}"'))
+        return '\n'.join(res) + '\n'
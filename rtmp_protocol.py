@@ -1,32 +1,56 @@
 from rtmp_errors import *
-from rtmp_stream import StreamObject
-from amf0_protocol import AMF0
+from rtmp_stream import StreamObject, ChunkStream
+from amf0_protocol import AMF0, LazyAMF0
 from rtmp_constants import *
 import time
 import struct
 
 
-class RTMPHeader:
+class SlottedObject:
+    """
+    base class for the slotted objects created for every message.
+    subclass `__init__` must set every slot
+    """
+    __slots__ = ()
+
+    def _update(self, kwargs: dict):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        return
+
+    def __repr__(self):
+        values = ', '.join(f"{key}={getattr(self, key, None)!r}" for key in type(self).__slots__)
+        return f"{type(self).__name__}({values})"
+
+
+class RTMPHeader(SlottedObject):
     """
     handling rtmp chunk header.
     - make an object with kwargs then use compile method to compile header
     - make an object with arg, only accepting [packet: bytes],
         then use parse method to parse received header
     """
+    # define object keys
+    __slots__ = ('chunk_stream_id', 'timestamp_delta', 'message_length', 'chunk_type',
+                 'message_stream_id', 'fmt', 'header_index', 'timestamp')
+    COMPILE_KEYS = ('chunk_stream_id', 'timestamp_delta', 'message_length', 'chunk_type',
+                    'message_stream_id', 'fmt')
+
     # define constants
     TIMESTAMP_MAX = 0xFFFFFF
-
-    # define object keys
-    chunk_stream_id = None
-    timestamp_delta = None
-    message_length = None
-    chunk_type = None
-    message_stream_id = None
-    fmt = None
-    header_index = 0
+    CHUNK_STREAM_ID_MAX = 65599
+    MESSAGE_HEADER_SIZE = (11, 7, 3, 0)  # by fmt
 
     def __init__(self, *args, **kwargs):
-        self.__dict__.update(kwargs)
+        self.chunk_stream_id = None
+        self.timestamp_delta = None
+        self.message_length = None
+        self.chunk_type = None
+        self.message_stream_id = None
+        self.fmt = None
+        self.header_index = 0
+        self.timestamp = None  # absolute timestamp, set when parsed as part of a chunk stream
+        self._update(kwargs)
 
         if len(args) == 1:
             self.parse(args[0])
@@ -34,16 +58,23 @@ class RTMPHeader:
         return
 
     def parse(self, packet: bytes):
-        _packet = packet[:]
+        total = len(packet)
+
+        if len(packet) == 0:
+            raise RTMP_NotHeader
 
         # Basic Header
-        fmt = packet[0] & 0b11000000
+        fmt = packet[0] >> 6
         cs_id = packet[0] & 0b00111111
         if cs_id == 0:  # 2 bytes chunk stream id
+            if len(packet) < 2:
+                raise RTMP_NotHeader
             cs_id = int(packet[1]) + 64
             packet = packet[2:]
         elif cs_id == 1:  # 3 bytes chunk stream id
-            cs_id = int(packet[2]) * 256 + int(packet[1]) * 64 + 64
+            if len(packet) < 3:
+                raise RTMP_NotHeader
+            cs_id = int(packet[2]) * 256 + int(packet[1]) + 64
             packet = packet[3:]
         else:  # 1 byte chunk stream id
             cs_id = int(cs_id)
@@ -65,6 +96,8 @@ class RTMPHeader:
             msg = packet[:]
         else:
             raise RTMP_NotHeader
+        if len(mheader) < self.MESSAGE_HEADER_SIZE[fmt]:
+            raise RTMP_NotHeader
 
         timedelta = int.from_bytes(mheader[0:3], 'big') if fmt < 3 else None
         mlen = int.from_bytes(mheader[3:6], 'big') if fmt < 2 else None
@@ -73,6 +106,8 @@ class RTMPHeader:
 
         # Extended Timestamp (optional)
         if timedelta is not None and timedelta == self.TIMESTAMP_MAX:
+            if len(msg) < 4:
+                raise RTMP_NotHeader
             timedelta = int.from_bytes(msg[0:4], 'big')
             msg = msg[4:]
 
@@ -82,28 +117,26 @@ class RTMPHeader:
         self.message_length = mlen
         self.chunk_type = mtype
         self.message_stream_id = mstreamid
-        self.header_index = len(_packet) - len(msg)
+        self.header_index = total - len(msg)
 
         return mheader, msg
 
     def compile(self):
-        if any([_ is None for _ in self.__dict__]):
+        if any([getattr(self, _) is None for _ in self.COMPILE_KEYS]):
             raise TypeError("not enough argument for RTMPHeader.compile")
 
         # Basic Header
         if self.fmt not in [0, 1, 2, 3]:
             raise TypeError("message type should be one of (0, 1, 2, 3)")
-        if self.chunk_stream_id < 2 or self.chunk_stream_id > 65597:
-            raise TypeError("chunk stream id should be in range [2, 65597]")
-        elif self.chunk_stream_id < 63:
+        if self.chunk_stream_id < 2 or self.chunk_stream_id > self.CHUNK_STREAM_ID_MAX:
+            raise TypeError(f"chunk stream id should be in range [2, {self.CHUNK_STREAM_ID_MAX}]")
+        elif self.chunk_stream_id < 64:
             res = struct.pack('>B', (self.fmt << 6) + self.chunk_stream_id)
-        elif self.chunk_stream_id < 319:
-            res = struct.pack('>B', (self.fmt << 6)) + \
-                  struct.pack('>B', self.chunk_stream_id - 64)
+        elif self.chunk_stream_id < 320:
+            res = struct.pack('>BB', (self.fmt << 6), self.chunk_stream_id - 64)
         else:
-            res = struct.pack('>B', (self.fmt << 6)) + \
-                  struct.pack('>B', self.chunk_stream_id - 64) + \
-                  struct.pack('>B', self.chunk_stream_id // 256)
+            res = struct.pack('>B', (self.fmt << 6) + 1) + \
+                  struct.pack('<H', self.chunk_stream_id - 64)
 
         # Message Header
         if self.fmt < 3:  # timestamp
@@ -115,7 +148,7 @@ class RTMPHeader:
             res += struct.pack('>I', self.message_length)[1:]  # message length
             res += struct.pack('>B', self.chunk_type)  # message type
         if self.fmt == 0:  # message stream id
-            res += struct.pack('>I', self.message_stream_id)[1:]
+            res += struct.pack('<I', self.message_stream_id)
 
         # extended timestamp
         if self.timestamp_delta >= self.TIMESTAMP_MAX:
@@ -124,21 +157,24 @@ class RTMPHeader:
         return res
 
 
-class RTMPPayload:
+class RTMPPayload(SlottedObject):
     """
     handling rtmp chunk payload.
     - make an object with kwargs then use compile method to compile payload
     - make an object with args, whose order is [header, Protocol.header, packet: bytes],
         then use parse method to parse received payload
     """
+    __slots__ = ('data', 'message')
 
     def __init__(self, *args, **kwargs):
         """
 
         :param args: [header: RTMPHeader, payload: bytes, stream: RTMPStreamObject]
-        :param kwargs:
+        :param kwargs: {data: bytes, message: AMF0 | LazyAMF0}
         """
-        self.__dict__.update(kwargs)
+        self.data = None
+        self.message = None
+        self._update(kwargs)
 
         if len(args) == 3:
             self.parse(args[0], args[1], args[2])
@@ -146,6 +182,7 @@ class RTMPPayload:
         return
 
     def parse(self, header: RTMPHeader, packet: bytes, stream: StreamObject):
+        self.data = packet
         if header.chunk_type in RTMP_CONTROL_TYPES and header.chunk_stream_id == RTMP_CONTROL_CID:
             # Protocol Control Message
             self.parse_protocol_control_message(header, packet, stream)
@@ -163,8 +200,19 @@ class RTMPPayload:
 
     def parse_amf0(self, header: RTMPHeader, msg: bytes, stream: StreamObject):
         # TODO execute message provided
-        amf = AMF0(msg)
-        amf0_obj = amf.obj
+        if header.chunk_type == TYPE_AMF0_DATA:
+            # data messages are relayed as they are, so only decode the name here.
+            # handlers can still decode the rest through `self.message.obj`
+            self.message = LazyAMF0(msg)
+            # metadata is kept for the whole session, copy it out of the receive buffer
+            if self.message.command == DATA_SET_DATA_FRAME:
+                # players expect `onMetaData`, which is what follows `@setDataFrame`
+                stream.metadata = bytes(self.message.body)
+            elif self.message.command == DATA_ON_METADATA:
+                stream.metadata = bytes(self.message.raw)
+            return
+
+        self.message = AMF0(msg)
         if header.chunk_type == TYPE_AMF0_COMMAND:
             pass
 
@@ -173,9 +221,13 @@ class RTMPPayload:
         if header.chunk_type == TYPE_CONTROL_SET_CHUNK:
             if len(msg) != 4:
                 raise RTMP_MultiplePacketsInBuffer
-            size = int.from_bytes(msg, 'big') & 0x7fff
-            stream.max_size = size
-            print(f"set max buffer size to {stream.max_size}")
+            size = int.from_bytes(msg, 'big') & RTMP_MAX_CHUNK_SIZE
+            if size == 0:
+                # nothing could be received anymore
+                raise RTMP_ProtocolError("peer set chunk size to 0")
+            # no message is longer, a larger chunk size would only let a chunk grow past any message
+            stream.chunk_size = min(size, RTMP_MAX_MESSAGE_LENGTH)
+            stream.log.info("set chunk size to %d", stream.chunk_size)
             return True
         elif header.chunk_type == TYPE_CONTROL_ABORT_MESSAGE:
             if len(msg) != 4:
@@ -187,6 +239,7 @@ class RTMPPayload:
             if len(msg) != 4:
                 raise RTMP_MultiplePacketsInBuffer
             seq_no = int.from_bytes(msg, 'big')
+            stream.metrics.ack(seq_no)
             # TODO implement control message
         elif header.chunk_type == TYPE_CONTROL_ACK_SIZE:
             if len(msg) != 4:
@@ -212,21 +265,9 @@ class RTMPPayload:
         return False
 
 
-def _merge(li: list):
-    while True:
-        if any([isinstance(_, list) for _ in li]):
-            tmp = li
-            li = li[:-1]
-            li.append(tmp[-1][0])
-            li.append(tmp[-1][1])
-        else:
-            break
-    return li
-
-
-class RTMP:
-    header = None
-    body = None
+class RTMP(SlottedObject):
+    __slots__ = ('header', 'body', 'mtype', 'cid', 'mid', 'timedelta', 'fmt', 'chunk')
+    COMPILE_KEYS = ('mtype', 'cid', 'mid', 'timedelta', 'fmt', 'chunk')
 
     def __init__(self, *args, **kwargs):
         """
@@ -242,7 +283,15 @@ class RTMP:
             - amf3: bool
             used when sending amf message. true for amf3, false for amf0 encoding
         """
-        self.__dict__.update(kwargs)
+        self.header = None
+        self.body = None
+        self.mtype = None
+        self.cid = None
+        self.mid = None
+        self.timedelta = None
+        self.fmt = None
+        self.chunk = None
+        self._update(kwargs)
 
         if len(args) == 2:
             self.parse(args[0], args[1])
@@ -250,38 +299,111 @@ class RTMP:
         return
 
     def parse(self, msg: bytes, stream: StreamObject):
+        """
+        parse every complete message in `msg`, returns list of RTMP objects (may be empty).
+        - chunks of a message split into several chunks are collected in `stream.chunk_streams`
+        - bytes of an incomplete chunk at the end are kept in `stream.chunk_pending`,
+            and parsed in front of `msg` of the next call. they are only parsed again once
+            `stream.chunk_needed` bytes are there, a large chunk is not parsed again on every read
+        """
+        if stream.FLAG_CHUNK_PENDING:
+            stream.chunk_pending += msg
+            if len(stream.chunk_pending) < stream.chunk_needed:
+                return []
+            msg = stream.chunk_pending
+        # slicing a memoryview does not copy the rest of the buffer for every message
+        msg = memoryview(msg)
+
+        ret = []
+        current = self
+        while len(msg) > 0:
+            try:
+                msg = current.parse_message(msg, stream)
+            except RTMP_ChunkNotFullyReceived:
+                break
+            if current.body is not None:
+                ret.append(current)
+                current = RTMP()
+
+        stream.FLAG_CHUNK_PENDING = len(msg) > 0
+        # a new buffer, message bodies may still be views of the previous one
+        stream.chunk_pending = bytearray(msg)
+        return ret
+
+    def parse_message(self, msg: bytes, stream: StreamObject):
+        """
+        parse the first chunk in `msg`, returns bytes left after the chunk.
+        `self.body` is only set when the chunk completes a message.
+        """
+        self.body = None
         try:
-            self.header = RTMPHeader(msg)
+            self.header = header = RTMPHeader(msg)
         except RTMP_NotHeader:
+            self.header = None
+            stream.chunk_needed = 0  # not known before the header is
             raise RTMP_ChunkNotFullyReceived
-        finally:
-            body_bytes = msg[self.header.header_index:]
 
-        try:
-            self.body = RTMPPayload(self.header, body_bytes, stream)
-            ret = [self]
-        except RTMP_ChunkNotFullyReceived:
+        state = stream.chunk_streams.get(header.chunk_stream_id)
+        if state is None:
+            state = stream.chunk_streams[header.chunk_stream_id] = ChunkStream()
+
+        # headers of type 1/2/3 inherit what they do not carry from the previous chunk
+        fmt = header.fmt
+        index = header.header_index
+        if fmt == 3:
+            delta = state.timestamp_delta
+            extended = state.extended
+            if extended:  # extended timestamp is repeated on type 3 chunks
+                index += 4
+        else:
+            delta = header.timestamp_delta
+            extended = delta >= RTMPHeader.TIMESTAMP_MAX
+        length = header.message_length if fmt < 2 else state.message_length
+        mtype = header.chunk_type if fmt < 2 else state.chunk_type
+        msid = header.message_stream_id if fmt == 0 else state.message_stream_id
+
+        received = 0 if state.buffer is None else len(state.buffer)
+        end = index + min(length - received, stream.chunk_size)
+        if len(msg) < end:
+            stream.chunk_needed = end
             raise RTMP_ChunkNotFullyReceived
-        except RTMP_MultiplePacketsInBuffer:
-            idx = len(body_bytes)
-            while True:
-                try:
-                    self.body = RTMPPayload(self.header, body_bytes[:idx], stream)
-                    break
-                except RTMP_MultiplePacketsInBuffer:
-                    idx -= 1
-                    continue
-            secondary = RTMP(body_bytes[idx:], stream)
-            ret = [self, secondary]
-
-        finally:
-            ret = _merge(ret)
-
-        return ret
 
-    def compile(self):
-        # TODO compile
-        if len(self.__dict__) != 6:
+        # the chunk is complete, update chunk stream state
+        stream.metrics.chunk(end - index)
+        if state.buffer is None:  # first chunk of a message
+            state.timestamp = delta if fmt == 0 else state.timestamp + delta
+        state.timestamp_delta = delta
+        state.extended = extended
+        state.message_length = length
+        state.chunk_type = mtype
+        state.message_stream_id = msid
+
+        header.timestamp_delta = delta
+        header.timestamp = state.timestamp
+        header.message_length = length
+        header.chunk_type = mtype
+        header.message_stream_id = msid
+
+        if received == 0 and end - index == length:  # single chunk message, no copy
+            body = msg[index:end]
+        else:
+            if state.buffer is None:
+                state.buffer = bytearray()
+            state.buffer += msg[index:end]
+            if len(state.buffer) < length:
+                return msg[end:]
+            body = bytes(state.buffer)
+            state.buffer = None
+
+        self.body = RTMPPayload(header, body, stream)
+        return msg[end:]
+
+    def compile(self, chunk_size: int = None):
+        """
+        :param chunk_size: outbound chunk size. when the payload is larger,
+            it is split into chunks continued with type 3 headers
+        """
+        if any([getattr(self, _) is None for _ in self.COMPILE_KEYS]):
             raise TypeError('not enough argument for RTMP.compile')
 
         if 'data' in self.chunk:  # protocol/user control message TODO support other message type for client support
@@ -302,9 +424,20 @@ class RTMP:
                             message_stream_id=self.mid,
                             message_length=len(payload),
                             fmt=self.fmt)
-        res = header.compile() + payload
+        first = header.compile()
+        if chunk_size is None or len(payload) <= chunk_size:
+            return first + payload
 
-        return res
+        # continuation chunks only carry the basic header (+ extended timestamp)
+        header.fmt = 3
+        following = header.compile()
+
+        view = memoryview(payload)
+        res = [first, view[:chunk_size]]
+        for idx in range(chunk_size, len(payload), chunk_size):
+            res.append(following)
+            res.append(view[idx:idx + chunk_size])
+        return b''.join(res)
 
     def make_protocol_control(self, type: int, data: bytes, timedelta: int):
         args = {
@@ -317,7 +450,7 @@ class RTMP:
             },
             'fmt': 0
         }
-        self.__dict__.update(args)
+        self._update(args)
         return self.compile()
 
     def make_control_set_chunk(self, stream: StreamObject, size: int):
@@ -333,3 +466,56 @@ class RTMP:
             data=struct.pack('>I', size),
             timedelta=int(time.time() - stream.start_time)
         )
+
+    def make_peer_bandwidth(self, stream: StreamObject, size: int, limit_type: int = BANDWIDTH_LIMIT_DYNAMIC):
+        return self.make_protocol_control(
+            type=TYPE_CONTROL_SET_BANDWIDTH,
+            data=struct.pack('>IB', size, limit_type),
+            timedelta=int(time.time() - stream.start_time)
+        )
+
+    def make_user_control(self, stream: StreamObject, event: int, data: bytes):
+        return self.make_protocol_control(
+            type=TYPE_USER_CONTROL_MESSAGE,
+            data=struct.pack('>H', event) + data,
+            timedelta=int(time.time() - stream.start_time)
+        )
+
+    def make_command(self, stream: StreamObject, name: str, transaction_id: float, *args,
+                     mid: int = RTMP_CONTROL_MID):
+        """amf0 command message, e.g. `make_command(stream, '_result', 1.0, properties, information)`"""
+        args = {
+            'mtype': TYPE_AMF0_COMMAND,
+            'cid': RTMP_COMMAND_CID,
+            'mid': mid,
+            'timedelta': 0,
+            'chunk': {
+                'message': (name, transaction_id) + args,
+                'amf3': False
+            },
+            'fmt': 0
+        }
+        self._update(args)
+        return self.compile(chunk_size=stream.max_size)
+
+    def make_media(self, mtype: int, timestamp: int, data: bytes, chunk_size: int,
+                   mid: int = RTMP_STREAM_MID):
+        """audio/video/data message as it is relayed to players"""
+        if mtype == TYPE_AUDIO:
+            cid = RTMP_AUDIO_CID
+        elif mtype == TYPE_VIDEO:
+            cid = RTMP_VIDEO_CID
+        else:
+            cid = RTMP_DATA_CID
+        args = {
+            'mtype': mtype,
+            'cid': cid,
+            'mid': mid,
+            'timedelta': timestamp,
+            'chunk': {
+                'data': data
+            },
+            'fmt': 0
+        }
+        self._update(args)
+        return self.compile(chunk_size=chunk_size)
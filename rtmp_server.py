@@ -1,8 +1,10 @@
 from rtmp_baseclass import RtmpBaseServer
+from rtmp_logging import setup_logging
 import os
 
 SERVER_HOST = '0.0.0.0'
 SERVER_PORT = 12345
 
+setup_logging()
 server = RtmpBaseServer((SERVER_HOST, SERVER_PORT,), os.getcwd() + "\\temp\\")
 server.run()
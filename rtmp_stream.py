@@ -1,20 +1,116 @@
+from rtmp_capture import CaptureWriter
+from rtmp_constants import RTMP_DEFAULT_CHUNK_SIZE
+from rtmp_dvr import DVRBuffer
+from rtmp_hls import HLSSegmenter
+from rtmp_logging import ConnectionLogger
+from rtmp_metrics import StreamMetrics
 import socket
 
 
+class ChunkStream:
+    """
+    state of a single chunk stream (csid) of a connection.
+    headers of type 1/2/3 only carry what changed since the previous chunk on the same chunk stream.
+    """
+    __slots__ = ('timestamp', 'timestamp_delta', 'message_length', 'chunk_type', 'message_stream_id',
+                 'extended', 'buffer')
+
+    def __init__(self):
+        self.timestamp = 0
+        self.timestamp_delta = 0
+        self.message_length = 0
+        self.chunk_type = 0
+        self.message_stream_id = 0
+        self.extended = False
+        self.buffer = None  # bytearray of the message being received, None between messages
+
+
+class HandshakeState:
+    """connection between accept and its NetConnection.connect"""
+    __slots__ = ('peer', 'log', 'deadline', 'buffer', 'rand')
+
+    def __init__(self, peer: str, log: ConnectionLogger, deadline: float):
+        self.peer = peer
+        self.log = log
+        self.deadline = deadline  # time.monotonic() the connection is dropped at, if connect is not answered
+        self.buffer = bytearray()  # handshake bytes received so far
+        self.rand = None  # random bytes of s1, set once s0+s1+s2 are sent
+
+
+class RelayState:
+    """connection to another server made by us, between connect and the answer to publish/play"""
+    __slots__ = ('client', 'stream_name', 'publish', 'deadline')
+
+    def __init__(self, client, stream_name: str, publish: bool, deadline: float):
+        self.client = client  # RtmpClient, running the setup steps
+        self.stream_name = stream_name
+        self.publish = publish  # push to an edge, or pull from the origin
+        self.deadline = deadline  # time.monotonic() the connection is dropped at, if setup is not done
+
+
 class StreamObject:
+    __slots__ = ('sock', 'stream_id', 'stream_path', 'max_size', 'chunk_pending', 'chunk_needed', 'FLAG_CHUNK_PENDING',
+                 'last_message_type', 'ack_window_size', 'sequence_size', 'start_time', 'metadata',
+                 'log', 'peer', 'metrics', 'chunk_size', 'chunk_streams', 'send_pending',
+                 'app', 'stream_key', 'FLAG_PUBLISH', 'FLAG_PLAY', 'video_config', 'audio_config', 'capture',
+                 'FLAG_RELAY', 'hls', 'dvr', 'dvr_cursor', 'FLAG_READ_PENDING')
+
     sock: socket.socket
     stream_id: str
     stream_path: str
     max_size: int
-    chunk_pending: bytes
+    chunk_pending: bytearray  # start of an incomplete chunk
+    chunk_needed: int  # bytes `chunk_pending` needs before it is worth parsing again
     FLAG_CHUNK_PENDING: bool
     last_message_type: int
     ack_window_size: int
     sequence_size: int
     start_time: int
+    metadata: bytes  # `onMetaData` message, sent to players before any frame
+    log: ConnectionLogger
+    peer: str
+    metrics: StreamMetrics
+    chunk_size: int  # inbound chunk size, set by the peer
+    chunk_streams: dict  # csid -> ChunkStream
+    send_pending: bytearray  # outbound bytes not accepted by the socket yet
+    app: str
+    stream_key: str  # `app/name` being published or played
+    FLAG_PUBLISH: bool
+    FLAG_PLAY: bool
+    video_config: bytes  # sequence headers, sent to players before any frame
+    audio_config: bytes
+    capture: CaptureWriter  # raw inbound bytes are recorded here when set
+    FLAG_RELAY: bool  # connection to another server, made by us (origin pull or edge push)
+    hls: HLSSegmenter  # set while publishing, when the server writes hls
+    dvr: DVRBuffer  # set while publishing, when the server keeps a time-shift buffer
+    dvr_cursor: int  # next dvr frame of a time-shifted player, None once live
+    FLAG_READ_PENDING: bool  # read budget ran out with data left, the socket is in the server's ready queue
 
     def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+        self.log = None
+        self.peer = None
+        self.chunk_size = RTMP_DEFAULT_CHUNK_SIZE
+        self.app = None
+        self.stream_key = None
+        self.capture = None
+        for key, value in kwargs.items():
+            setattr(self, key, value)
         self.FLAG_CHUNK_PENDING = False
-        self.chunk_pending = bytes()
+        self.chunk_pending = bytearray()
+        self.chunk_needed = 0
         self.last_message_type = -1
+        self.metadata = None
+        self.metrics = StreamMetrics()
+        self.chunk_streams = dict()
+        self.send_pending = bytearray()
+        self.FLAG_PUBLISH = False
+        self.FLAG_PLAY = False
+        self.FLAG_RELAY = False
+        self.hls = None
+        self.dvr = None
+        self.dvr_cursor = None
+        self.FLAG_READ_PENDING = False
+        self.video_config = None
+        self.audio_config = None
+        if self.log is None:
+            self.log = ConnectionLogger({'stream_id': kwargs.get('stream_id')})
@@ -0,0 +1,302 @@
+"""
+rtmp load generator.
+- N publishers push synthetic flv shaped h264/aac frames at the configured bitrate
+- M players play them back, spread over the publishers
+- every frame carries the wall clock time it was sent at, so players measure end to end latency
+everything runs in this process against a server on localhost. for more load, run several instances.
+
+usage: python rtmp_loadgen.py [--publishers 1] [--players 10] [--duration 30] [--video-kbps 2500] [--json]
+"""
+from socket_baseclass import *
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from amf0_protocol import AMF0  # noqa: E402
+from rtmp_client import RtmpClient  # noqa: E402
+from rtmp_constants import *  # noqa: E402
+from rtmp_protocol import RTMP  # noqa: E402
+from rtmp_stream import StreamObject  # noqa: E402
+
+APP = 'live'
+CHUNK_SIZE = 4096  # same as OBS
+SETUP_TIMEOUT = 10
+
+AUDIO_RATE = 44100 / 1024  # aac frames per second
+FRAME_STAMP = struct.Struct('>QI')  # send time (ns, wall clock), sequence number
+
+# flv tag headers of synthetic frames
+VIDEO_KEY = bytes([FLV_FRAME_KEY << 4 | FLV_CODEC_AVC, FLV_AVC_NALU, 0, 0, 0])
+VIDEO_INTER = bytes([2 << 4 | FLV_CODEC_AVC, FLV_AVC_NALU, 0, 0, 0])
+AUDIO_RAW = bytes([FLV_CODEC_AAC << 4 | 0x0f, FLV_AAC_RAW])
+VIDEO_CONFIG = bytes([FLV_FRAME_KEY << 4 | FLV_CODEC_AVC, FLV_AVC_SEQUENCE_HEADER, 0, 0, 0]) + \
+    bytes.fromhex('0164001fffe10004' '6764001f' '010004' '68ebecb2')  # avcC with a single sps/pps
+AUDIO_CONFIG = bytes([FLV_CODEC_AAC << 4 | 0x0f, FLV_AAC_SEQUENCE_HEADER]) + bytes.fromhex('1210')
+
+
+def percentile(values: list, p: float):
+    """`values` must be sorted"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class LoadClient(BaseClientApplication):
+    """
+    rtmp client set up synchronously by `RtmpClient`,
+    then handing the socket over to the scaffolding's watcher thread.
+    """
+    VERBOSE = False
+
+    def __init__(self, addr: tuple):
+        super().__init__(addr)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+        # inbound parser state. `max_size` is our outbound chunk size
+        self.stream = StreamObject(sock=self.socket, max_size=CHUNK_SIZE, start_time=time.time())
+        self.rtmp = RtmpClient(self.socket, self.stream, APP, SETUP_TIMEOUT)
+        self.closed = False
+
+    def start(self):
+        for message in self.rtmp.backlog:
+            self.on_message(message)
+        self.rtmp.backlog = []
+        # the rest goes through the scaffolding: `recv_callback` from its watcher thread
+        self.run()
+        return
+
+    def recv_callback(self, data: bytes, sock: socket.socket):
+        for message in RTMP().parse(data, self.stream):
+            self.on_message(message)
+
+    def on_message(self, message: RTMP):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        super().close()
+
+
+class Publisher(LoadClient):
+    def __init__(self, addr: tuple, stream_name: str, video_kbps: int, audio_kbps: int, fps: int, gop: float):
+        super().__init__(addr)
+        self.video_size = max(len(VIDEO_KEY) + FRAME_STAMP.size, video_kbps * 1000 // 8 // fps)
+        self.audio_size = max(len(AUDIO_RAW) + FRAME_STAMP.size, int(audio_kbps * 1000 / 8 / AUDIO_RATE))
+        self.fps = fps
+        self.gop = max(1, int(gop * fps))
+        self.bytes_sent = 0
+        self.frames = 0
+        self.late = 0
+        self.sender = None
+
+        self.rtmp.connect()
+        self.rtmp.publish(stream_name)
+        self.start()
+
+    def send_media(self, mtype: int, timestamp: int, data: bytes):
+        packet = RTMP().make_media(mtype, timestamp, data, CHUNK_SIZE)
+        self.socket.sendall(packet)
+        self.bytes_sent += len(packet)
+        return
+
+    def push(self, duration: float):
+        metadata = ('@setDataFrame', 'onMetaData', {
+            'width': 1280.0, 'height': 720.0, 'framerate': float(self.fps), 'videocodecid': float(FLV_CODEC_AVC),
+            'audiocodecid': float(FLV_CODEC_AAC), 'encoder': 'loadgen',
+        })
+        self.send_media(TYPE_AMF0_DATA, 0, AMF0(obj=list(metadata)).compile())
+        self.send_media(TYPE_VIDEO, 0, VIDEO_CONFIG)
+        self.send_media(TYPE_AUDIO, 0, AUDIO_CONFIG)
+
+        video_filler = bytes(self.video_size - len(VIDEO_KEY) - FRAME_STAMP.size)
+        audio_filler = bytes(self.audio_size - len(AUDIO_RAW) - FRAME_STAMP.size)
+        start = time.perf_counter()
+        video_no = audio_no = 0
+        while not self.closed:
+            video_due = video_no / self.fps
+            audio_due = audio_no / AUDIO_RATE
+            due = min(video_due, audio_due)
+            if due >= duration:
+                break
+
+            wait = start + due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            elif wait < -0.1:
+                self.late += 1
+
+            stamp = FRAME_STAMP.pack(time.time_ns(), self.frames)
+            timestamp = int(due * 1000)
+            try:
+                if video_due <= audio_due:
+                    flv = VIDEO_KEY if video_no % self.gop == 0 else VIDEO_INTER
+                    self.send_media(TYPE_VIDEO, timestamp, flv + stamp + video_filler)
+                    video_no += 1
+                else:
+                    self.send_media(TYPE_AUDIO, timestamp, AUDIO_RAW + stamp + audio_filler)
+                    audio_no += 1
+            except OSError:
+                break
+            self.frames += 1
+        return
+
+    def start_push(self, duration: float):
+        self.sender = threading.Thread(target=self.push, args=(duration,), daemon=True)
+        self.sender.start()
+
+
+class Player(LoadClient):
+    def __init__(self, addr: tuple, stream_name: str):
+        super().__init__(addr)
+        self.bytes_received = 0
+        self.frames = 0
+        self.latencies = []  # ms
+        self.measuring = False
+
+        self.rtmp.connect()
+        self.rtmp.play(stream_name)
+        self.start()
+
+    def recv_callback(self, data: bytes, sock: socket.socket):
+        if self.measuring:
+            self.bytes_received += len(data)
+        super().recv_callback(data, sock)
+
+    def on_message(self, message: RTMP):
+        mtype = message.header.chunk_type
+        data = message.body.data
+        if mtype == TYPE_VIDEO:
+            offset = len(VIDEO_KEY)
+        elif mtype == TYPE_AUDIO:
+            offset = len(AUDIO_RAW)
+        else:
+            return
+        # sequence headers carry no stamp
+        if len(data) < offset + FRAME_STAMP.size or data[1] != FLV_AVC_NALU:
+            return
+
+        sent, _ = FRAME_STAMP.unpack_from(data, offset)
+        self.frames += 1
+        if self.measuring:
+            self.latencies.append((time.time_ns() - sent) / 1000000)
+
+
+def connect_all(factories: list):
+    """run client factories in parallel, returns (clients, errors, elapsed seconds)"""
+    clients = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(factory):
+        try:
+            client = factory()
+        except (OSError, ConnectionError, IndexError) as e:
+            with lock:
+                errors.append(repr(e))
+            return
+        with lock:
+            clients.append(client)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(f,), daemon=True) for f in factories]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return clients, errors, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="rtmp load generator")
+    parser.add_argument('--host', default=CLIENT_HOST)
+    parser.add_argument('--port', type=int, default=CLIENT_PORT)
+    parser.add_argument('--play-host', help="play from another server (an edge), default --host")
+    parser.add_argument('--play-port', type=int, help="default --port")
+    parser.add_argument('--publishers', type=int, default=1)
+    parser.add_argument('--players', type=int, default=10, help="spread evenly over the publishers")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of streaming")
+    parser.add_argument('--video-kbps', type=int, default=2500)
+    parser.add_argument('--audio-kbps', type=int, default=128)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--gop', type=float, default=2, help="seconds between keyframes")
+    parser.add_argument('--prefix', default='load', help="stream names are <prefix><n>, use distinct prefixes "
+                                                         "for loadgens running against the same server")
+    parser.add_argument('--warmup', type=float, default=1, help="seconds before measuring latency")
+    parser.add_argument('--json', action='store_true', help="print the report as json")
+    args = parser.parse_args()
+    addr = (args.host, args.port)
+    play_addr = (args.play_host or args.host, args.play_port or args.port)
+
+    names = [f"{args.prefix}{i}" for i in range(args.publishers)]
+    publishers, publish_errors, publish_time = connect_all([
+        lambda n=n: Publisher(addr, n, args.video_kbps, args.audio_kbps, args.fps, args.gop) for n in names])
+    players, play_errors, play_time = connect_all([
+        lambda i=i: Player(play_addr, names[i % len(names)]) for i in range(args.players)] if names else [])
+
+    for p in publishers:
+        p.start_push(args.duration + args.warmup)
+    time.sleep(args.warmup)
+    for p in players:
+        p.measuring = True
+    sent_before = sum(p.bytes_sent for p in publishers)
+    start = time.perf_counter()
+
+    for p in publishers:
+        p.sender.join()
+    elapsed = time.perf_counter() - start
+    for p in players:
+        p.measuring = False
+    sent = sum(p.bytes_sent for p in publishers) - sent_before
+    time.sleep(0.5)  # let the last frames arrive
+
+    for c in publishers + players:
+        c.close()
+
+    latencies = sorted(_ for p in players for _ in p.latencies)
+    connections = len(publishers) + len(players)
+    report = {
+        'publishers': len(publishers),
+        'players': len(players),
+        'connection_errors': publish_errors + play_errors,
+        'connections_per_sec': connections / (publish_time + play_time) if connections else 0,
+        'duration': elapsed,
+        'ingest_mbps': sent * 8 / elapsed / 1000000 if elapsed else 0,
+        'egress_mbps': sum(p.bytes_received for p in players) * 8 / elapsed / 1000000 if elapsed else 0,
+        'frames_sent': sum(p.frames for p in publishers),
+        'frames_late': sum(p.late for p in publishers),
+        'frames_received': sum(p.frames for p in players),
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+        },
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"connections: {report['publishers']} publishers, {report['players']} players, "
+          f"{len(report['connection_errors'])} failed, {report['connections_per_sec']:.1f} conn/s")
+    for e in report['connection_errors'][:5]:
+        print(f"    {e}")
+    print(f"throughput: ingest {report['ingest_mbps']:.2f} Mbit/s, egress {report['egress_mbps']:.2f} Mbit/s "
+          f"over {elapsed:.1f}s")
+    print(f"frames: {report['frames_sent']} sent ({report['frames_late']} late), "
+          f"{report['frames_received']} received")
+    if latencies:
+        lat = report['latency_ms']
+        print(f"latency: p50 {lat['p50']:.1f} ms, p90 {lat['p90']:.1f} ms, p99 {lat['p99']:.1f} ms, "
+              f"max {lat['max']:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+replay raw ingest captures (see `RtmpBaseServer(capture=True)`) through the parser, offline.
+- buffers are fed with the same boundaries they were received with, so coalesced/split chunks replay as they came
+- `--realtime` keeps the original timing between buffers, by default they are fed as fast as possible
+- `--profile` runs the replay under cProfile
+a failing buffer is reported with its index and offset, the rest of the capture is still replayed.
+
+usage: python rtmp_replay.py capture.rtmpcap [...] [--realtime] [--repeat 1] [--profile] [--verbose] [--json]
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import rtmp_constants  # noqa: E402
+from rtmp_capture import CaptureReader  # noqa: E402
+from rtmp_errors import RTMP_ProtocolError, RTMP_MultiplePacketsInBuffer  # noqa: E402
+from rtmp_protocol import RTMP  # noqa: E402
+from rtmp_stream import StreamObject  # noqa: E402
+
+TYPE_NAMES = {v: k[len('TYPE_'):].lower() for k, v in vars(rtmp_constants).items() if k.startswith('TYPE_')}
+PROFILE_LINES = 30
+
+
+def describe(message: RTMP):
+    header = message.header
+    res = f"csid={header.chunk_stream_id} ts={header.timestamp} " \
+          f"type={TYPE_NAMES.get(header.chunk_type, header.chunk_type)} len={len(message.body.data)}"
+    if header.chunk_type == rtmp_constants.TYPE_AMF0_COMMAND:
+        res += f" {message.body.message.obj[:2]}"
+    elif header.chunk_type == rtmp_constants.TYPE_AMF0_DATA:
+        res += f" {message.body.message.command}"
+    return res
+
+
+def replay(path: str, realtime: bool = False, verbose: bool = False):
+    stream = StreamObject(stream_id=os.path.basename(path), max_size=1024 * 1024, start_time=0)
+    report = {
+        'path': path,
+        'buffers': 0,
+        'bytes': 0,
+        'messages': 0,
+        'max_messages_per_buffer': 0,
+        'types': dict(),
+        'errors': [],
+        'parse_seconds': 0.0,
+    }
+
+    with CaptureReader(path) as reader:
+        report['peer'] = reader.peer
+        start = time.monotonic()
+        for index, (offset, data) in enumerate(reader):
+            if realtime:
+                delay = offset - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            report['buffers'] += 1
+            report['bytes'] += len(data)
+            begin = time.perf_counter()
+            try:
+                messages = RTMP().parse(data, stream)
+            # keep going, a capture is replayed to find these
+            except (Exception, RTMP_ProtocolError, RTMP_MultiplePacketsInBuffer) as e:  # noqa
+                report['errors'].append({'buffer': index, 'offset': offset, 'length': len(data),
+                                         'error': repr(e)})
+                if verbose:
+                    traceback.print_exc()
+                continue
+            finally:
+                report['parse_seconds'] += time.perf_counter() - begin
+            report['messages'] += len(messages)
+            report['max_messages_per_buffer'] = max(report['max_messages_per_buffer'], len(messages))
+
+            for message in messages:
+                name = TYPE_NAMES.get(message.header.chunk_type, str(message.header.chunk_type))
+                report['types'][name] = report['types'].get(name, 0) + 1
+                if verbose:
+                    print(f"[{index} +{offset:.3f}s] {describe(message)}")
+
+    report['pending_bytes'] = len(stream.chunk_pending) if stream.FLAG_CHUNK_PENDING else 0
+    return report
+
+
+def print_report(report: dict):
+    elapsed = report['parse_seconds']
+    print(f"{report['path']} ({report['peer']})")
+    print(f"    {report['buffers']} buffers, {report['bytes']} bytes, {report['messages']} messages "
+          f"(max {report['max_messages_per_buffer']} per buffer), {report['pending_bytes']} bytes left pending")
+    print("    " + ", ".join(f"{k}: {v}" for k, v in sorted(report['types'].items())))
+    if elapsed:
+        print(f"    parse: {elapsed * 1000:.1f} ms, {report['bytes'] / elapsed / 1000000:.1f} MB/s, "
+              f"{report['messages'] / elapsed:.0f} msg/s")
+    for e in report['errors'][:10]:
+        print(f"    error at buffer {e['buffer']} (+{e['offset']:.3f}s, {e['length']} bytes): {e['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay rtmp ingest captures through the parser")
+    parser.add_argument('captures', nargs='+')
+    parser.add_argument('--realtime', action='store_true', help="keep the original timing between buffers")
+    parser.add_argument('--repeat', type=int, default=1, help="replay every capture this many times")
+    parser.add_argument('--profile', action='store_true', help="print cProfile stats of the replay")
+    parser.add_argument('--verbose', action='store_true', help="print every message and parse error")
+    parser.add_argument('--json', action='store_true', help="print the reports as json")
+    args = parser.parse_args()
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    reports = [replay(path, args.realtime, args.verbose) for _ in range(args.repeat) for path in args.captures]
+    if profiler is not None:
+        profiler.disable()
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print_report(report)
+    if profiler is not None:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(PROFILE_LINES)
+
+    return 1 if any(r['errors'] for r in reports) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -104,6 +104,9 @@ class BaseServerApplication:
 
 
 class BaseClientApplication:
+    # log every received packet, turn off when receiving a lot (e.g. load testing)
+    VERBOSE = True
+
     def __init__(self, addr: tuple):
         self.socket = socket.create_connection(addr)
 
@@ -120,7 +123,8 @@ class BaseClientApplication:
         # check EOT
         data = sock.recv(MAX_BUFFER_SIZE)
         if data:
-            print(f"[{datetime.now().isoformat()}] received data: length ({len(data)})")
+            if self.VERBOSE:
+                print(f"[{datetime.now().isoformat()}] received data: length ({len(data)})")
             # call callback function
             self.recv_callback(data, sock)
         else:  # EOT packet
@@ -136,7 +140,7 @@ class BaseClientApplication:
     def add_thread(self):
         def watcher(blocker: threading.Event):
             while blocker.is_set():
-                event = self.sel.select(-1)
+                event = self.sel.select(0.1)  # wake up now and then to see if we're closed
                 for key, mask in event:
                     callback = key.data
                     callback(key.fileobj, self.sel)
@@ -161,7 +165,8 @@ class BaseClientApplication:
     def close(self):
         self.thread_event.clear()
         for t in self.threads:
-            t.join()
+            if t is not threading.current_thread():  # closed from the watcher itself (EOT)
+                t.join()
 
         self.sel.unregister(self.socket)
         self.sel.close()
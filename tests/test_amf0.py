@@ -0,0 +1,75 @@
+"""
+malformed amf0 input must raise what the server drops a single peer on (`PROTOCOL_ERRORS`), nothing else.
+
+usage: python -m pytest tests (or python -m unittest discover tests)
+"""
+import os
+import random
+import struct
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from amf0_protocol import AMF0, LazyAMF0, MAX_DEPTH  # noqa: E402
+from rtmp_baseclass import PROTOCOL_ERRORS  # noqa: E402
+
+
+class TestDate(unittest.TestCase):
+    def test_date(self):
+        msg = b'\x0b' + struct.pack('>d', 1700000000000.0) + b'\x00\x00' + b'\x05'
+        self.assertEqual(AMF0(msg).obj, [datetime.fromtimestamp(1700000000), None])
+
+    def test_date_out_of_range(self):
+        for value in (1e300, -1e300, float('inf'), float('nan')):
+            with self.assertRaises(ValueError):
+                AMF0(b'\x0b' + struct.pack('>d', value) + b'\x00\x00')
+        with self.assertRaises(ValueError):
+            AMF0(b'\x0b' + b'\x7f' * 10)
+
+    def test_date_truncated(self):
+        with self.assertRaises(ValueError):
+            AMF0(b'\x0b' + struct.pack('>d', 0.0))
+
+    def test_connect_with_date(self):
+        # `connect` carrying a date value, as it killed the server
+        msg = AMF0(obj=['connect', 1.0]).compile() + b'\x0b' + b'\xff' * 10
+        with self.assertRaises(PROTOCOL_ERRORS):
+            AMF0(msg)
+
+
+class TestDepth(unittest.TestCase):
+    def test_nested_arrays(self):
+        ok = b'\x0a\x00\x00\x00\x01' * MAX_DEPTH + b'\x05'
+        self.assertEqual(len(AMF0(ok).obj), 1)
+        with self.assertRaises(ValueError):
+            AMF0(b'\x0a\x00\x00\x00\x01' * 500 + b'\x05')
+
+    def test_nested_objects(self):
+        with self.assertRaises(ValueError):
+            AMF0(b'\x03' + b'\x00\x01a\x03' * 500)
+        with self.assertRaises(ValueError):
+            AMF0(b'\x08\x00\x00\x00\x01' + b'\x00\x01a\x08\x00\x00\x00\x01' * 500)
+
+
+class TestFuzz(unittest.TestCase):
+    def test_random_payloads(self):
+        rng = random.Random(20261019)
+        markers = bytes([0x00, 0x01, 0x02, 0x03, 0x05, 0x06, 0x08, 0x0a, 0x0b, 0x0c])
+        seed = AMF0(obj=['connect', 1.0, {'app': 'live', 'tcUrl': 'rtmp://host/live', 'list': [1.0, 'a']}]).compile()
+        for _ in range(5000):
+            msg = bytearray(seed)
+            for _ in range(rng.randint(1, 8)):
+                pos = rng.randrange(len(msg))
+                msg[pos] = rng.choice(markers) if rng.random() < 0.5 else rng.randrange(256)
+            msg = bytes(msg[:rng.randint(1, len(msg))])
+            try:
+                AMF0(msg)
+                LazyAMF0(msg).obj
+            except PROTOCOL_ERRORS:
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+chunk stream reassembly of `RTMP.parse`: header inheritance, extended timestamps, split chunks.
+
+usage: python -m pytest tests (or python -m unittest discover tests)
+"""
+import os
+import struct
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from rtmp_constants import *  # noqa: E402
+from rtmp_errors import RTMP_ProtocolError  # noqa: E402
+from rtmp_protocol import RTMP, RTMPHeader  # noqa: E402
+from rtmp_stream import StreamObject  # noqa: E402
+
+
+def chunk(fmt, cid, payload=b'', timestamp=0, mtype=TYPE_VIDEO, length=None, mid=RTMP_STREAM_MID):
+    """a single chunk, header fields the format does not carry are ignored"""
+    header = RTMPHeader(chunk_stream_id=cid, timestamp_delta=timestamp, chunk_type=mtype,
+                        message_stream_id=mid, message_length=len(payload) if length is None else length,
+                        fmt=fmt)
+    return header.compile() + payload
+
+
+def new_stream():
+    return StreamObject(max_size=RTMP_DEFAULT_CHUNK_SIZE, start_time=time.time())
+
+
+def media(mtype, timestamp, data, chunk_size):
+    return RTMP().make_media(mtype, timestamp, data, chunk_size)
+
+
+def parse(data, stream, read_size=None):
+    """parse `data` delivered in reads of `read_size` bytes, returns (timestamp, type, msid, body) of each message"""
+    read_size = read_size or len(data)
+    ret = []
+    for idx in range(0, len(data), read_size):
+        for message in RTMP().parse(data[idx:idx + read_size], stream):
+            header = message.header
+            ret.append((header.timestamp, header.chunk_type, header.message_stream_id, bytes(message.body.data)))
+    return ret
+
+
+class TestHeaders(unittest.TestCase):
+    def setUp(self):
+        self.stream = new_stream()
+
+    def test_inherit(self):
+        data = chunk(0, 6, b'aaaaa', timestamp=1000, mid=1) + \
+            chunk(1, 6, b'bbb', timestamp=33, mtype=TYPE_AUDIO) + \
+            chunk(2, 6, b'ccc', timestamp=40) + \
+            chunk(3, 6, b'ddd')
+        self.assertEqual(parse(data, self.stream), [
+            (1000, TYPE_VIDEO, 1, b'aaaaa'),
+            (1033, TYPE_AUDIO, 1, b'bbb'),  # type 1: new length and type, same message stream
+            (1073, TYPE_AUDIO, 1, b'ccc'),  # type 2: new delta only
+            (1113, TYPE_AUDIO, 1, b'ddd'),  # type 3: delta of the previous chunk again
+        ])
+
+    def test_chunk_streams_apart(self):
+        data = chunk(0, 6, b'v', timestamp=100) + chunk(0, 4, b'a', timestamp=200, mtype=TYPE_AUDIO) + \
+            chunk(3, 6, b'v') + chunk(3, 4, b'a')
+        self.assertEqual([_[:2] for _ in parse(data, self.stream)], [
+            (100, TYPE_VIDEO), (200, TYPE_AUDIO), (200, TYPE_VIDEO), (400, TYPE_AUDIO),
+        ])
+
+
+class TestExtendedTimestamp(unittest.TestCase):
+    def setUp(self):
+        self.stream = new_stream()
+
+    def test_single_chunk(self):
+        data = media(TYPE_VIDEO, 0x1000000, b'frame', RTMP_DEFAULT_CHUNK_SIZE)
+        self.assertEqual(parse(data, self.stream), [(0x1000000, TYPE_VIDEO, RTMP_STREAM_MID, b'frame')])
+
+    def test_repeated_on_type3(self):
+        # continuation chunks repeat the extended timestamp, it is not part of the payload
+        payload = bytes(range(256)) * 2
+        data = media(TYPE_VIDEO, 0xFFFFFF, payload, RTMP_DEFAULT_CHUNK_SIZE)
+        self.assertEqual(data.count(struct.pack('>I', 0xFFFFFF)), 4)
+        self.assertEqual(parse(data, self.stream), [(0xFFFFFF, TYPE_VIDEO, RTMP_STREAM_MID, payload)])
+
+    def test_type3_new_message(self):
+        # a type 3 header starting a new message adds the extended delta again
+        data = chunk(0, 6, b'a', timestamp=0x1000000) + chunk(3, 6, b'b', timestamp=0x1000000)
+        self.assertEqual([_[0] for _ in parse(data, self.stream)], [0x1000000, 0x2000000])
+
+
+class TestSplit(unittest.TestCase):
+    def setUp(self):
+        self.stream = new_stream()
+        self.payload = os.urandom(1000)
+
+    def test_chunks(self):
+        data = media(TYPE_VIDEO, 40, self.payload, RTMP_DEFAULT_CHUNK_SIZE)
+        self.assertEqual(parse(data, self.stream), [(40, TYPE_VIDEO, RTMP_STREAM_MID, self.payload)])
+
+    def test_interleaved(self):
+        # an audio message between the chunks of a video message
+        video = chunk(0, 6, self.payload[:128], timestamp=40, length=len(self.payload))
+        video += chunk(3, 6, self.payload[128:256])
+        audio = chunk(0, 4, b'audio', timestamp=50, mtype=TYPE_AUDIO)
+        rest = b''.join(chunk(3, 6, self.payload[idx:idx + 128]) for idx in range(256, 1000, 128))
+        self.assertEqual(parse(video + audio + rest, self.stream), [
+            (50, TYPE_AUDIO, RTMP_STREAM_MID, b'audio'),
+            (40, TYPE_VIDEO, RTMP_STREAM_MID, self.payload),
+        ])
+
+    def test_reads(self):
+        data = media(TYPE_VIDEO, 0xFFFFFF, self.payload, RTMP_DEFAULT_CHUNK_SIZE) + \
+            media(TYPE_AUDIO, 10, b'audio', RTMP_DEFAULT_CHUNK_SIZE)
+        expected = [(0xFFFFFF, TYPE_VIDEO, RTMP_STREAM_MID, self.payload), (10, TYPE_AUDIO, RTMP_STREAM_MID, b'audio')]
+        for read_size in (1, 3, 7, 100, 1460):
+            with self.subTest(read_size=read_size):
+                self.assertEqual(parse(data, new_stream(), read_size), expected)
+
+    def test_large_chunk(self):
+        # a whole message in one chunk after the peer raised its chunk size, received in small reads
+        payload = os.urandom(1 << 20)
+        stream = new_stream()
+        data = RTMP().make_control_set_chunk(stream, len(payload)) + media(TYPE_VIDEO, 0, payload, len(payload))
+        self.assertEqual(parse(data, stream, 1460), [
+            (0, TYPE_CONTROL_SET_CHUNK, RTMP_CONTROL_MID, struct.pack('>I', len(payload))),
+            (0, TYPE_VIDEO, RTMP_STREAM_MID, payload),
+        ])
+
+
+class TestChunkSize(unittest.TestCase):
+    def test_zero(self):
+        stream = new_stream()
+        with self.assertRaises(RTMP_ProtocolError):
+            RTMP().parse(RTMP().make_control_set_chunk(stream, 0), stream)
+
+    def test_clamped(self):
+        stream = new_stream()
+        RTMP().parse(RTMP().make_control_set_chunk(stream, RTMP_MAX_CHUNK_SIZE), stream)
+        self.assertEqual(stream.chunk_size, RTMP_MAX_MESSAGE_LENGTH)
+
+
+if __name__ == '__main__':
+    unittest.main()